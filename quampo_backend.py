@@ -1,15 +1,46 @@
+import time
+_T0_IMPORT = time.perf_counter()
 import os
 import json
+import random
+import asyncio
+import logging
 import tempfile
+import threading
+import unicodedata
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import zipfile
-import io
 import numpy as np
 import rasterio
 from rasterio.errors import RasterioIOError
+from rasterio.shutil import copy as copiar_raster
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
 from datetime import datetime, timedelta
-from openai import OpenAI
-import ee
+from quampo_cache import CACHE_DIR, CacheEscenas, CacheTTL, cacheado, clave_hash, cuantizar
+from quampo_traza import contar, en_hilo, etapa, span, traza
+from quampo_indices import (
+    BANDAS,
+    DELTA_ESCALA,
+    DELTA_NODATA,
+    NODATA,
+    BandasCrudas,
+    STREAM_PIXELS,
+    Acumulador,
+    EXPRESIONES,
+    Clases,
+    IndicesPerezosos,
+    acumular_en_paralelo,
+    acumular_zonas,
+    cambios_por_franjas,
+    etiquetas_zonas,
+    promedios_por_franjas,
+    seleccionar_indices,
+    vista_previa
+)
 
 # === Configuration Constants ===
 LLM_MODEL = "gpt-4o"
@@ -20,6 +51,36 @@ CLOUD_THRESHOLD      = int(os.getenv("CLOUD_THRESHOLD",20))
 SCALE                = int(os.getenv("SCALE",          30))
 BUFFER_M             = int(os.getenv("BUFFER_M",      2500))
 FORECAST_DAYS        = int(os.getenv("FORECAST_DAYS",   7))
+DOWNLOAD_CHUNK       = int(os.getenv("DOWNLOAD_CHUNK", 1 << 20))
+COG_BLOCK            = int(os.getenv("COG_BLOCK", 512))          # tesela de las escenas guardadas
+COG_COMPRESS         = os.getenv("COG_COMPRESS", "DEFLATE")
+
+SELECTION_TTL        = int(os.getenv("SELECTION_TTL", 6 * 3600))  # caché de la elección de imagen
+
+# HTTP: sesión compartida con pool de conexiones, reintentos y timeouts
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT    = float(os.getenv("HTTP_READ_TIMEOUT",   30))   # entre bytes, no total
+HTTP_RETRIES         = int(os.getenv("HTTP_RETRIES",   3))
+HTTP_BACKOFF         = float(os.getenv("HTTP_BACKOFF", 0.5))  # 0.5s, 1s, 2s… (+ Retry-After)
+HTTP_JITTER          = float(os.getenv("HTTP_JITTER",  0.5))  # hasta tantos segundos al azar por espera
+HTTP_POOL            = int(os.getenv("HTTP_POOL",     16))   # conexiones por host
+
+# Caché de geocodificación y clima: TTL (segundos) y grilla (grados)
+GEOCODE_TTL          = int(os.getenv("GEOCODE_TTL",  30 * 86400))
+WEATHER_TTL          = int(os.getenv("WEATHER_TTL",  30 * 60))
+FORECAST_TTL         = int(os.getenv("FORECAST_TTL", 3 * 3600))
+WEATHER_GRID         = float(os.getenv("WEATHER_GRID", 0.01))
+LOOKUP_CACHE_DISK    = os.getenv("LOOKUP_CACHE_DISK", "0") == "1"
+LLM_CACHE_TTL        = int(os.getenv("LLM_CACHE_TTL",   24 * 3600))
+LLM_CACHE_ITEMS      = int(os.getenv("LLM_CACHE_ITEMS", 1024))
+LLM_METRICS_ITEMS    = int(os.getenv("LLM_METRICS_ITEMS", 256))  # métricas por llamada retenidas
+ANALYSIS_TTL         = int(os.getenv("ANALYSIS_TTL",   24 * 3600))  # análisis de una escena (promedios/clases)
+ANALYSIS_ITEMS       = int(os.getenv("ANALYSIS_ITEMS", 256))
+
+# Timeouts (segundos) de cada dependencia externa en generar_informe
+GEE_TIMEOUT          = float(os.getenv("GEE_TIMEOUT",     60))
+WEATHER_TIMEOUT      = float(os.getenv("WEATHER_TIMEOUT", 15))
+PHENO_TIMEOUT        = float(os.getenv("PHENO_TIMEOUT",   30))
 
 LLM_TEMPERATURE      = float(os.getenv("LLM_TEMPERATURE",  0.7))
 LLM_MAX_TOKENS       = int(os.getenv("LLM_MAX_TOKENS", 1024))
@@ -30,25 +91,164 @@ PHENO_MAX_TOKENS     = int(os.getenv("PHENO_MAX_TOKENS",    50))
 PLAN_TEMPERATURE     = float(os.getenv("PLAN_TEMPERATURE",   0.5))
 PLAN_MAX_TOKENS      = int(os.getenv("PLAN_MAX_TOKENS",    200))
 
-# === Google Earth Engine Initialization ===
-SA_PATH = 'service_account.json'
-if not os.path.exists(SA_PATH):
-    raise FileNotFoundError(f"Service account file not found: {SA_PATH}")
-with open(SA_PATH) as f:
-    sa_info = json.load(f)
-credentials = ee.ServiceAccountCredentials(sa_info['client_email'], SA_PATH)
-ee.Initialize(credentials)
-
-# === API Keys and OpenAI Client ===
-OPENAI_API_KEY      = os.getenv("OPENAI_API_KEY")
-OPENWEATHER_API_KEY = os.getenv("OPENWEATHER_API_KEY")
-GOOGLE_MAPS_API_KEY = os.getenv("GOOGLE_MAPS_API_KEY")
-for key, val in [("OPENAI_API_KEY", OPENAI_API_KEY),
-                 ("OPENWEATHER_API_KEY", OPENWEATHER_API_KEY),
-                 ("GOOGLE_MAPS_API_KEY", GOOGLE_MAPS_API_KEY)]:
+# === Lazy initialization of external clients ===
+# Importar este módulo no abre credenciales ni hace llamadas de red: Earth
+# Engine y OpenAI se inicializan en el primer uso (una sola vez, thread-safe)
+# y pueden reemplazarse con set_ee / set_client.
+SA_PATH = os.getenv("SA_PATH", 'service_account.json')
+
+log = logging.getLogger("quampo.backend")
+
+_init_lock = threading.Lock()
+_ee = None
+client = None
+_sesion = None
+TIEMPOS_INICIO = {}   # segundos de import y de cada inicialización
+
+def _registrar_inicio(nombre, t0):
+    # Arranque en frío: se guarda (lo reporta el benchmark) y se loguea una vez
+    TIEMPOS_INICIO[nombre] = time.perf_counter() - t0
+    log.info("Inicialización de %s: %.2fs (import del backend: %.2fs)",
+             nombre, TIEMPOS_INICIO[nombre], TIEMPOS_INICIO.get('import', float('nan')))
+
+def _api_key(nombre):
+    val = os.getenv(nombre)
     if not val:
-        raise EnvironmentError(f"Falta {key} en env vars")
-client = OpenAI(api_key=OPENAI_API_KEY)
+        raise EnvironmentError(f"Falta {nombre} en env vars")
+    return val
+
+def get_ee():
+    """Módulo `ee` inicializado con la cuenta de servicio de SA_PATH."""
+    global _ee
+    if _ee is None:
+        with _init_lock:
+            if _ee is None:
+                t0 = time.perf_counter()
+                import ee
+                if not os.path.exists(SA_PATH):
+                    raise FileNotFoundError(f"Service account file not found: {SA_PATH}")
+                with open(SA_PATH) as f:
+                    sa_info = json.load(f)
+                credentials = ee.ServiceAccountCredentials(sa_info['client_email'], SA_PATH)
+                ee.Initialize(credentials)
+                _ee = ee
+                _registrar_inicio('ee', t0)
+    return _ee
+
+def set_ee(modulo_ee):
+    """Inyecta un módulo `ee` ya inicializado (o un fake compatible)."""
+    global _ee
+    _ee = modulo_ee
+
+def get_client():
+    """Cliente de chat; la primera llamada construye el de OpenAI."""
+    global client
+    if client is None:
+        with _init_lock:
+            if client is None:
+                t0 = time.perf_counter()
+                from openai import OpenAI
+                client = OpenAI(api_key=_api_key("OPENAI_API_KEY"))
+                _registrar_inicio('openai', t0)
+    return client
+
+def get_session():
+    """
+    Sesión HTTP compartida: hasta HTTP_POOL conexiones por host (los hilos
+    de más esperan una libre) y reintentos con backoff exponencial con
+    jitter para los errores de conexión y las respuestas 429/5xx,
+    respetando Retry-After.
+    """
+    global _sesion
+    if _sesion is None:
+        with _init_lock:
+            if _sesion is None:
+                reintentos = Retry(
+                    total=HTTP_RETRIES,
+                    backoff_factor=HTTP_BACKOFF,
+                    backoff_jitter=HTTP_JITTER,
+                    status_forcelist=(429, 500, 502, 503, 504),
+                    allowed_methods=frozenset({'GET'}),
+                    respect_retry_after_header=True,
+                    raise_on_status=False
+                )
+                adaptador = HTTPAdapter(pool_connections=HTTP_POOL, pool_maxsize=HTTP_POOL,
+                                        pool_block=True, max_retries=reintentos)
+                sesion = requests.Session()
+                sesion.mount('https://', adaptador)
+                sesion.mount('http://', adaptador)
+                _sesion = sesion
+    return _sesion
+
+def set_session(sesion):
+    """Reemplaza la sesión HTTP (cualquier objeto con `get` compatible)."""
+    global _sesion
+    _sesion = sesion
+
+def _espera_reintento(intento):
+    # Misma espera que Retry: backoff exponencial más jitter uniforme
+    return HTTP_BACKOFF * 2 ** intento + random.uniform(0, HTTP_JITTER)
+
+def _http_get(url, **kwargs):
+    kwargs.setdefault('timeout', (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    return get_session().get(url, **kwargs)
+
+async def http_get_async(url, servicio=None, **kwargs):
+    """
+    `_http_get` para orquestación con asyncio: la llamada corre en el
+    executor por defecto del loop (asyncio.to_thread, que conserva la traza
+    activa) con la misma sesión, pool, reintentos y timeouts, y dentro del
+    límite de `servicio` (ver set_limites). Esperar una conexión libre o el
+    semáforo no bloquea el event loop.
+    """
+    def llamar():
+        with _limite(servicio):
+            return _http_get(url, **kwargs)
+    return await asyncio.to_thread(llamar)
+
+# === Concurrencia por servicio externo ===
+# Máximo de llamadas simultáneas a cada servicio ('gee', 'geocode', 'clima',
+# 'llm'), aplicado donde se hace cada llamada; sin límite por defecto. El
+# modo lote los fija con set_limites.
+_limites = {}   # servicio -> (máximo, semáforo)
+_SIN_LIMITE = nullcontext()
+
+def set_limites(limites):
+    """Fija los límites ({servicio: n o None = sin límite}) y devuelve los anteriores."""
+    global _limites
+    anteriores = {k: n for k, (n, _) in _limites.items()}
+    _limites = {k: (n, threading.BoundedSemaphore(n)) for k, n in limites.items() if n}
+    return anteriores
+
+def _limite(servicio):
+    par = _limites.get(servicio)
+    return par[1] if par is not None else _SIN_LIMITE
+
+def set_client(nuevo_client):
+    """
+    Reemplaza el cliente de chat (cualquier objeto con la interfaz
+    `chat.completions.create` de OpenAI, p. ej. un fake local en tests o
+    benchmarks) y vacía la caché de respuestas.
+    """
+    global client
+    client = nuevo_client
+    cache_llm.limpiar()
+
+# === Caché de escenas Sentinel-2 y de consultas externas ===
+cache_escenas = CacheEscenas()
+_disco_consultas = CacheEscenas(os.path.join(CACHE_DIR, 'consultas'), nombre='consultas') if LOOKUP_CACHE_DISK else None
+cache_geocode  = CacheTTL(GEOCODE_TTL,  disco=_disco_consultas, nombre='geocode')
+cache_clima    = CacheTTL(WEATHER_TTL,  disco=_disco_consultas, nombre='clima')
+cache_forecast = CacheTTL(FORECAST_TTL, disco=_disco_consultas, nombre='pronostico')
+cache_llm      = CacheTTL(LLM_CACHE_TTL, max_items=LLM_CACHE_ITEMS, nombre='llm')
+cache_analisis = CacheTTL(ANALYSIS_TTL, max_items=ANALYSIS_ITEMS, nombre='analisis')
+
+def _clave_lugar(location_name):
+    # "  San  Pedro, BA " y "san pedro, ba" comparten entrada
+    return ' '.join(unicodedata.normalize('NFKC', location_name).lower().split())
+
+def _clave_celda(lat, lon):
+    return cuantizar(lat, lon, WEATHER_GRID)
 
 # === System prompt ===
 system_prompt_llm = '''
@@ -69,26 +269,34 @@ Siempre hablá en español simple, con profesionalismo.
 '''
 
 # === Geocoding ===
+@cacheado(cache_geocode, _clave_lugar)
+@etapa('geocode')
 def geocode_location(location_name):
     url = (
         f"https://maps.googleapis.com/maps/api/geocode/json?"
-        f"address={requests.utils.quote(location_name)}&key={GOOGLE_MAPS_API_KEY}"
+        f"address={requests.utils.quote(location_name)}&key={_api_key('GOOGLE_MAPS_API_KEY')}"
     )
-    resp = requests.get(url, timeout=10)
-    data = resp.json()
+    contar('llamadas_externas', servicio='geocode')
+    with _limite('geocode'):
+        resp = _http_get(url)
+        data = resp.json()
     if resp.status_code != 200 or data.get('status') != 'OK' or not data.get('results'):
         raise ValueError("No se pudo geocodificar la localidad")
     loc = data['results'][0]['geometry']['location']
     return loc['lat'], loc['lng']
 
 # === Weather Retrieval ===
+@cacheado(cache_clima, _clave_celda, cachear=lambda v: v is not None)
+@etapa('clima')
 def obtener_clima_current(lat, lon):
     url = (
         f"https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}"
-        f"&units=metric&lang=es&appid={OPENWEATHER_API_KEY}"
+        f"&units=metric&lang=es&appid={_api_key('OPENWEATHER_API_KEY')}"
     )
-    resp = requests.get(url, timeout=10)
-    data = resp.json()
+    contar('llamadas_externas', servicio='clima')
+    with _limite('clima'):
+        resp = _http_get(url)
+        data = resp.json()
     if resp.status_code != 200 or 'main' not in data:
         return None
     return {
@@ -98,13 +306,17 @@ def obtener_clima_current(lat, lon):
         'lluvia':     f"{data.get('rain', {}).get('1h', 0)} mm"
     }
 
+@cacheado(cache_forecast, _clave_celda, cachear=bool)
+@etapa('pronostico')
 def get_extended_forecast(lat, lon):
     url = (
         f"https://api.openweathermap.org/data/2.5/onecall?lat={lat}&lon={lon}"
-        f"&exclude=current,minutely,hourly,alerts&units=metric&lang=es&appid={OPENWEATHER_API_KEY}"
+        f"&exclude=current,minutely,hourly,alerts&units=metric&lang=es&appid={_api_key('OPENWEATHER_API_KEY')}"
     )
-    resp = requests.get(url, timeout=10)
-    data = resp.json()
+    contar('llamadas_externas', servicio='pronostico')
+    with _limite('clima'):
+        resp = _http_get(url)
+        data = resp.json()
     if resp.status_code != 200 or 'daily' not in data:
         return []
     forecast = []
@@ -119,88 +331,353 @@ def get_extended_forecast(lat, lon):
     return forecast
 
 # === Earth Engine Image Functions ===
-def get_gee_image_url(lat, lon, date_str,
-                      window_days=WINDOW_DAYS,
-                      cloud_threshold=CLOUD_THRESHOLD,
-                      scale=SCALE,
-                      buffer_m=BUFFER_M):
-    try:
-        target = datetime.fromisoformat(date_str).date()
-    except ValueError:
-        return None, None, None
+def _get_info(objeto, nombre):
+    # Cada getInfo es un viaje al servidor de Earth Engine
+    contar('llamadas_externas', servicio='gee')
+    with _limite('gee'), span('gee.' + nombre):
+        return objeto.getInfo()
+
+def _seleccion_gee(geom, date_str, window_days, cloud_threshold):
+    # Elección de imagen del lado del servidor: la de menor nubosidad en la
+    # ventana ±window_days o, si no hay, la última anterior a date_str
+    ee = get_ee()
+    target = datetime.fromisoformat(date_str).date()
     start = (target - timedelta(days=window_days)).isoformat()
     end   = (target + timedelta(days=window_days)).isoformat()
-    geom = ee.Geometry.Point([lon, lat])
     coll = (ee.ImageCollection('COPERNICUS/S2_SR')
             .filterBounds(geom)
             .filterMetadata('CLOUDY_PIXEL_PERCENTAGE','less_than',cloud_threshold))
     window = coll.filterDate(start, end).sort('CLOUDY_PIXEL_PERCENTAGE')
-    if window.size().getInfo() > 0:
-        image, notice = window.first(), f"Imagen en ventana {start}–{end}"
-    else:
-        before = coll.filterDate('2015-01-01', date_str).sort('system:time_start', False)
-        if before.size().getInfo() == 0:
-            return None, None, None
-        image, notice = before.first(), f"Imagen previa antes de {date_str}"
-    ts = image.get('system:time_start').getInfo()
-    actual_date = datetime.utcfromtimestamp(ts/1000).strftime('%Y-%m-%d')
-    region = geom.buffer(buffer_m).bounds().getInfo()['coordinates']
-    url = image.getDownloadURL({
-        'bands': ['B4','B3','B2','B8','B8A','B11'],
-        'scale': scale,
-        'crs': 'EPSG:4326',
-        'region': region,
-        'fileFormat': 'GEO_TIFF'
+    before = coll.filterDate('2015-01-01', date_str).sort('system:time_start', False)
+    en_ventana = window.size().gt(0)
+    hay = en_ventana.Or(before.size().gt(0))
+    image = ee.Image(ee.Algorithms.If(en_ventana, window.first(), before.first()))
+    consulta = ee.Dictionary({
+        'hay': hay,
+        'en_ventana': en_ventana,
+        'id': ee.Algorithms.If(hay, image.get('system:id'), ''),
+        'ts': ee.Algorithms.If(hay, image.get('system:time_start'), 0)
     })
-    return url, actual_date, notice
+    return consulta, (start, end)
 
-def get_gee_image_dates(lat, lon):
-    today    = datetime.utcnow().date().isoformat()
-    prev     = (datetime.utcnow().date() - timedelta(days=30)).isoformat()
-    year_ago = (datetime.utcnow().date() - timedelta(days=365)).isoformat()
+def _seleccionar_imagenes(lat, lon, fechas,
+                          window_days=WINDOW_DAYS,
+                          cloud_threshold=CLOUD_THRESHOLD,
+                          buffer_m=BUFFER_M):
+    """
+    Resuelve en un único getInfo la imagen elegida para cada fecha de
+    `fechas` ({clave: 'YYYY-MM-DD'}) y la región de descarga.
+    Devuelve (region, {clave: (image_id, fecha_real, aviso) o None}).
+    """
+    ee = get_ee()
+    geom = ee.Geometry.Point([lon, lat])
+    consultas, ventanas = {}, {}
+    for clave, date_str in fechas.items():
+        try:
+            consultas[clave], ventanas[clave] = _seleccion_gee(geom, date_str, window_days, cloud_threshold)
+        except ValueError:
+            continue
+    if not consultas:
+        return None, dict.fromkeys(fechas)
+    info = _get_info(ee.Dictionary({
+        'region': geom.buffer(buffer_m).bounds().coordinates(),
+        'imagenes': ee.Dictionary(consultas)
+    }), 'seleccion')
+
+    seleccion = {}
+    for clave, date_str in fechas.items():
+        d = info['imagenes'].get(clave)
+        if not d or not d['hay']:
+            seleccion[clave] = None
+            continue
+        start, end = ventanas[clave]
+        if d['en_ventana']:
+            notice = f"Imagen en ventana {start}–{end}"
+        else:
+            notice = f"Imagen previa antes de {date_str}"
+        actual_date = datetime.utcfromtimestamp(d['ts']/1000).strftime('%Y-%m-%d')
+        seleccion[clave] = (d['id'], actual_date, notice)
+    return info['region'], seleccion
+
+def _url_descarga(image_id, region, scale=SCALE):
+    contar('llamadas_externas', servicio='gee')
+    with _limite('gee'), span('gee.url'):
+        # UInt16 nativo (la mitad que float32) y nodata explícito
+        imagen = get_ee().Image(image_id).select(list(BANDAS)).toUint16().unmask(NODATA)
+        return imagen.getDownloadURL({
+            'bands': list(BANDAS),
+            'scale': scale,
+            'crs': 'EPSG:4326',
+            'region': region,
+            'fileFormat': 'GEO_TIFF'
+        })
+
+def get_gee_image_url(lat, lon, date_str,
+                      window_days=WINDOW_DAYS,
+                      cloud_threshold=CLOUD_THRESHOLD,
+                      scale=SCALE,
+                      buffer_m=BUFFER_M):
+    region, seleccion = _seleccionar_imagenes(lat, lon, {'fecha': date_str},
+                                              window_days, cloud_threshold, buffer_m)
+    if seleccion['fecha'] is None:
+        return None, None, None
+    image_id, actual_date, notice = seleccion['fecha']
+    return _url_descarga(image_id, region, scale), actual_date, notice
+
+def _fechas_referencia(fecha=None):
+    today = datetime.fromisoformat(fecha).date() if fecha else datetime.utcnow().date()
     return {
-        'actual': get_gee_image_url(lat, lon, today),
-        'anterior': get_gee_image_url(lat, lon, prev),
-        'anio_atras': get_gee_image_url(lat, lon, year_ago)
+        'actual': today.isoformat(),
+        'anterior': (today - timedelta(days=30)).isoformat(),
+        'anio_atras': (today - timedelta(days=365)).isoformat()
     }
 
+def get_gee_image_dates(lat, lon):
+    # Una sola evaluación para las tres fechas; solo las URLs de descarga
+    # quedan como llamadas aparte, y se piden en paralelo
+    region, seleccion = _seleccionar_imagenes(lat, lon, _fechas_referencia())
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        futs = {k: en_hilo(ex, _url_descarga, s[0], region) for k, s in seleccion.items() if s}
+        return {k: (futs[k].result(), s[1], s[2]) if s else (None, None, None)
+                for k, s in seleccion.items()}
+
+@etapa('descarga')
 def download_and_stack_gee_tif(url: str, output_path: str) -> str:
-    resp = requests.get(url, stream=True)
-    resp.raise_for_status()
-    z = zipfile.ZipFile(io.BytesIO(resp.content))
-    tifs = sorted([n for n in z.namelist() if n.lower().endswith('.tif')])
-    with z.open(tifs[0]) as f0:
-        with rasterio.open(io.BytesIO(f0.read())) as src0:
+    """
+    Descarga el ZIP de GEE a disco por bloques y apila sus bandas en un único
+    Cloud Optimized GeoTIFF (teselado, comprimido y con overviews internos).
+    Cada banda se lee directamente del ZIP vía /vsizip/ y se copia ventana
+    por ventana a un GeoTIFF teselado intermedio, sin cargar el archivo ni
+    las bandas en memoria; el COG se genera a partir de ese intermedio.
+    """
+    fd, zip_path = tempfile.mkstemp(suffix=".zip")
+    fd_apilado, apilado = tempfile.mkstemp(suffix=".tif")
+    os.close(fd_apilado)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            # La conexión y el status ya los reintenta el adaptador; acá solo
+            # se reintentan (desde cero) los cortes a mitad del cuerpo, que
+            # Retry no cubre
+            for intento in range(HTTP_RETRIES + 1):
+                contar('llamadas_externas', servicio='gee_descarga')
+                f.seek(0)
+                f.truncate()
+                with _limite('gee'), _http_get(url, stream=True) as resp:
+                    resp.raise_for_status()
+                    try:
+                        for chunk in resp.iter_content(chunk_size=DOWNLOAD_CHUNK):
+                            f.write(chunk)
+                            contar('bytes_descargados', len(chunk))
+                        break
+                    except (requests.ConnectionError, requests.Timeout,
+                            requests.exceptions.ChunkedEncodingError):
+                        if intento == HTTP_RETRIES:
+                            raise
+                time.sleep(_espera_reintento(intento))
+        with zipfile.ZipFile(zip_path) as z:
+            tifs = sorted([n for n in z.namelist() if n.lower().endswith('.tif')], key=_orden_banda)
+        bandas = [f"/vsizip/{zip_path}/{name}" for name in tifs]
+        with rasterio.open(bandas[0]) as src0:
             meta = src0.meta.copy()
-    meta.update(count=len(tifs))
-    with rasterio.open(output_path, 'w', **meta) as dst:
-        for i, name in enumerate(tifs, 1):
-            with z.open(name) as f:
-                with rasterio.open(io.BytesIO(f.read())) as src:
-                    dst.write(src.read(1), i)
+        meta.update(count=len(bandas), driver='GTiff', tiled=True,
+                    blockxsize=COG_BLOCK, blockysize=COG_BLOCK, BIGTIFF='IF_SAFER')
+        # GEE no marca el nodata: los píxeles enmascarados llegan como NODATA
+        if meta.get('nodata') is None and np.issubdtype(np.dtype(meta['dtype']), np.integer):
+            meta['nodata'] = NODATA
+        with rasterio.open(apilado, 'w', **meta) as dst:
+            for i, banda in enumerate(bandas, 1):
+                with rasterio.open(banda) as src:
+                    for _, w in src.block_windows(1):
+                        dst.write(src.read(1, window=w), i, window=w)
+        # El driver COG ordena teselas y overviews (promedio, respetando nodata)
+        copiar_raster(apilado, output_path, driver='COG', COMPRESS=COG_COMPRESS,
+                      PREDICTOR='YES', BLOCKSIZE=COG_BLOCK, OVERVIEW_RESAMPLING='AVERAGE',
+                      BIGTIFF='IF_SAFER', NUM_THREADS='ALL_CPUS')
+    finally:
+        os.remove(zip_path)
+        os.remove(apilado)
     return output_path
 
-def download_gee_image(lat, lon, date_str,
-                       window_days=WINDOW_DAYS,
-                       max_cloud_pct=CLOUD_THRESHOLD,
-                       scale=SCALE,
-                       buffer_m=BUFFER_M):
-    url, actual_date, notice = get_gee_image_url(lat, lon, date_str,
-                                                  window_days, max_cloud_pct,
-                                                  scale, buffer_m)
-    if not url:
-        return None, {}
-    out_tif = tempfile.mktemp(suffix=".tif")
-    download_and_stack_gee_tif(url, out_tif)
-    return out_tif, {
+def _orden_banda(nombre):
+    # 'download.B8A.tif' -> posición en BANDAS (el orden alfabético pondría B11 antes que B2)
+    banda = nombre.rsplit('.', 2)[-2] if nombre.count('.') >= 2 else nombre
+    return (BANDAS.index(banda) if banda in BANDAS else len(BANDAS), nombre)
+
+def _selecciones_cacheadas(lat, lon, fechas, window_days, max_cloud_pct, buffer_m):
+    # {clave: (region, image_id, fecha_real, aviso) o None} para un punto ya
+    # cuantizado; las fechas que no están en caché se resuelven en un solo getInfo
+    claves = {k: clave_hash('seleccion', lat, lon, d, window_days, max_cloud_pct, buffer_m)
+              for k, d in fechas.items()}
+    sels = {k: cache_escenas.leer_json(c, SELECTION_TTL) for k, c in claves.items()}
+    faltan = {k: fechas[k] for k, sel in sels.items() if sel is None}
+    if faltan:
+        region, seleccion = _seleccionar_imagenes(lat, lon, faltan,
+                                                  window_days, max_cloud_pct, buffer_m)
+        for k, sel in seleccion.items():
+            if sel is not None:
+                sels[k] = [region, *sel]
+                cache_escenas.guardar_json(claves[k], sels[k])
+    return sels
+
+def _seleccion_cacheada(lat, lon, date_str, window_days, max_cloud_pct, buffer_m):
+    # (region, image_id, fecha_real, aviso) para un punto ya cuantizado, o None
+    return _selecciones_cacheadas(lat, lon, {'fecha': date_str},
+                                  window_days, max_cloud_pct, buffer_m)['fecha']
+
+def _escena_cacheada(lat, lon, region, image_id, scale, buffer_m):
+    # Misma imagen, punto, región y escala: mismo archivo (y misma grilla)
+    clave = clave_hash('escena', image_id, lat, lon, BANDAS, scale, 'EPSG:4326', buffer_m, 'cog')
+    out_tif = cache_escenas.obtener(clave)
+    if out_tif is None:
+        url = _url_descarga(image_id, region, scale)
+        out_tif = cache_escenas.guardar(clave, lambda tmp: download_and_stack_gee_tif(url, tmp))
+    return out_tif
+
+def _meta_gee(sel, date_str, max_cloud_pct, scale, buffer_m):
+    _, image_id, actual_date, notice = sel
+    return {
         'requested_date': date_str,
         'actual_date': actual_date,
         'notice': notice,
         'cloud_pct': max_cloud_pct,
         'scale': scale,
-        'buffer_m': buffer_m
+        'buffer_m': buffer_m,
+        'image_id': image_id
     }
 
+def download_gee_image(lat, lon, date_str,
+                       window_days=WINDOW_DAYS,
+                       max_cloud_pct=CLOUD_THRESHOLD,
+                       scale=SCALE,
+                       buffer_m=BUFFER_M):
+    # El punto se cuantiza para que el mismo lote reutilice la caché
+    lat, lon = cuantizar(lat, lon)
+    sel = _seleccion_cacheada(lat, lon, date_str, window_days, max_cloud_pct, buffer_m)
+    if sel is None:
+        return None, {}
+    out_tif = _escena_cacheada(lat, lon, sel[0], sel[1], scale, buffer_m)
+    return out_tif, _meta_gee(sel, date_str, max_cloud_pct, scale, buffer_m)
+
+def _medias_ee(image, geom, scale, indices):
+    # ee.Dictionary con la media regional de cada índice, calculado como
+    # álgebra de bandas con la misma normalización que procesar_imagen
+    # (máximo de las 6 bandas en la región)
+    ee = get_ee()
+    reducir = dict(geometry=geom, scale=scale, crs='EPSG:4326', maxPixels=1e10)
+    img = image.select(list(BANDAS)).toFloat()
+    maxv = ee.Number(img.reduceRegion(ee.Reducer.max(), **reducir).values().reduce(ee.Reducer.max()))
+    norm = img.divide(ee.Number(ee.Algorithms.If(maxv.gt(1), maxv, 1)))
+    bandas = {v: norm.select(b) for v, b in zip(('R', 'G', 'B', 'N', 'RE', 'S'), BANDAS)}
+    stack = ee.Image.cat([norm.expression(EXPRESIONES[k], bandas).rename(k) for k in indices])
+    return stack.reduceRegion(ee.Reducer.mean(), **reducir)
+
+def promedios_gee(lat, lon, date_str,
+                  window_days=WINDOW_DAYS,
+                  max_cloud_pct=CLOUD_THRESHOLD,
+                  scale=SCALE,
+                  buffer_m=BUFFER_M,
+                  indices=None):
+    """
+    Alternativa a download_gee_image + procesar_imagen cuando solo hacen
+    falta los números: calcula los índices como álgebra de bandas en Earth
+    Engine y los promedia con reduceRegion sobre la misma región, sin
+    transferir el raster. Devuelve (promedios, meta) como download_gee_image
+    devuelve (ruta, meta); (None, {}) si no hay imagen.
+    """
+    lat, lon = cuantizar(lat, lon)
+    sel = _seleccion_cacheada(lat, lon, date_str, window_days, max_cloud_pct, buffer_m)
+    if sel is None:
+        return None, {}
+    region, image_id = sel[0], sel[1]
+    meta = _meta_gee(sel, date_str, max_cloud_pct, scale, buffer_m)
+
+    sel_idx = seleccionar_indices(indices)
+    clave = clave_hash('zonal', image_id, lat, lon, scale, 'EPSG:4326', buffer_m, sel_idx)
+    promedios = cache_escenas.leer_json(clave, float('inf'))   # la escena no cambia
+    if promedios is None:
+        ee = get_ee()
+        geom = ee.Geometry.Polygon(region)
+        medias = _get_info(_medias_ee(ee.Image(image_id), geom, scale, sel_idx), 'promedios')
+        promedios = {k: float('nan') if medias.get(k) is None else float(medias[k]) for k in sel_idx}
+        cache_escenas.guardar_json(clave, promedios)
+    return promedios, meta
+
+def serie_temporal(lat, lon, desde, hasta=None,
+                   indices=('NDVI', 'NDMI'),
+                   cloud_threshold=CLOUD_THRESHOLD,
+                   scale=SCALE,
+                   buffer_m=BUFFER_M):
+    """
+    Trayectoria de índices del lote entre `desde` y `hasta` (ISO, por
+    defecto hoy): una fila por fecha con imagen de COPERNICUS/S2_SR bajo
+    `cloud_threshold`. Las medias se calculan en Earth Engine sobre toda la
+    colección en un único getInfo.
+
+    La serie se guarda en caché y se extiende en forma incremental: una
+    consulta posterior solo pide los tramos no cubiertos (escenas más nuevas
+    que la última guardada, o anteriores al inicio guardado).
+    Devuelve columnas {'fecha': [...], 'nubosidad': [...], índice: [...]}.
+    """
+    sel = seleccionar_indices(indices)
+    hasta = hasta or datetime.utcnow().date().isoformat()
+    lat, lon = cuantizar(lat, lon)
+    clave = clave_hash('serie', lat, lon, sel, cloud_threshold, scale, buffer_m)
+    cache = cache_escenas.leer_json(clave, float('inf')) or {'desde': None, 'hasta': None, 'filas': []}
+
+    # Tramos faltantes: antes del inicio cacheado y después de la última escena
+    # (la cola se vuelve a consultar si pasó SELECTION_TTL: GEE ingesta con demora)
+    reciente = (cache['hasta'] is not None and hasta <= cache['hasta']
+                and time.time() - cache.get('actualizado', 0) < SELECTION_TTL)
+    tramos = []
+    if cache['desde'] is None:
+        tramos.append((desde, hasta))
+    else:
+        if desde < cache['desde']:
+            tramos.append((desde, cache['desde']))
+        ultima = max([f['fecha'] for f in cache['filas']], default=None)
+        inicio = ((datetime.fromisoformat(ultima) + timedelta(days=1)).date().isoformat()
+                  if ultima else cache['desde'])
+        if inicio <= hasta and not reciente:
+            tramos.append((inicio, hasta))
+
+    if tramos:
+        ee = get_ee()
+        geom = ee.Geometry.Point([lon, lat])
+        region = geom.buffer(buffer_m).bounds()
+        fin = lambda d: (datetime.fromisoformat(d) + timedelta(days=1)).date().isoformat()
+        filtro = ee.Filter.Or(*[ee.Filter.date(a, fin(b)) for a, b in tramos])
+        coll = (ee.ImageCollection('COPERNICUS/S2_SR')
+                .filterBounds(geom)
+                .filterMetadata('CLOUDY_PIXEL_PERCENTAGE', 'less_than', cloud_threshold)
+                .filter(filtro))
+
+        def por_imagen(image):
+            return ee.Feature(None, _medias_ee(image, region, scale, sel).combine({
+                't': image.get('system:time_start'),
+                'nubosidad': image.get('CLOUDY_PIXEL_PERCENTAGE')
+            }))
+
+        feats = coll.map(por_imagen)
+        nuevas = _get_info(feats.toList(feats.size()).map(lambda f: ee.Feature(f).toDictionary()), 'serie')
+        filas = {f['fecha']: f for f in cache['filas']}
+        for d in nuevas:
+            fila = {'fecha': datetime.utcfromtimestamp(d['t'] / 1000).strftime('%Y-%m-%d'),
+                    'nubosidad': float(d['nubosidad']),
+                    **{k: float(d[k]) if d.get(k) is not None else float('nan') for k in sel}}
+            # Varias teselas el mismo día: queda la menos nublada
+            previa = filas.get(fila['fecha'])
+            if previa is None or fila['nubosidad'] < previa['nubosidad']:
+                filas[fila['fecha']] = fila
+        cola = any(b == hasta for _, b in tramos)
+        cache = {'desde': min(desde, cache['desde'] or desde),
+                 'hasta': max(hasta, cache['hasta'] or hasta) if cola else cache['hasta'],
+                 'actualizado': time.time() if cola else cache.get('actualizado', 0),
+                 'filas': sorted(filas.values(), key=lambda f: f['fecha'])}
+        cache_escenas.guardar_json(clave, cache)
+
+    filas = [f for f in cache['filas'] if desde <= f['fecha'] <= hasta]
+    return {col: [f[col] for f in filas] for col in ('fecha', 'nubosidad', *sel)}
+
 # === Glossary ===
 glossary = {
     'NDVI':  {'interpretacion': [
@@ -251,18 +728,106 @@ glossary = {
 }
 
 # === Interpret Index Deterministically ===
+# EVI no usa el glosario: tiene cortes propios, sin límites de rango
+CLASES_EVI = Clases(
+    ["Superficie no vegetal (agua, sombra…)", "Vegetación escasa o suelo desnudo",
+     "Vegetación moderada", "Vegetación densa", "Cobertura muy densa de vegetación"],
+    [0.0, 0.2, 0.5, 0.8],
+    empate_superior=[True, False, False, False]   # 0 cae en "escasa" (evi >= 0)
+)
+# Bordes precalculados para clasificar cada índice (por píxel y el promedio)
+CLASES_GLOSARIO = {k: Clases.desde_glosario(v['interpretacion'])
+                   for k, v in glossary.items() if k != 'EVI'}
+CLASES_GLOSARIO['EVI'] = CLASES_EVI
+
 def interpretar_indice(valor, nombre):
-    if nombre == 'EVI':
-        evi = max(valor, -1.0)
-        if evi > 0.8: return "Cobertura muy densa de vegetación"
-        elif evi > 0.5: return "Vegetación densa"
-        elif evi > 0.2: return "Vegetación moderada"
-        elif evi >= 0:  return "Vegetación escasa o suelo desnudo"
-        else: return "Superficie no vegetal (agua, sombra…)"
-    for r in glossary[nombre]['interpretacion']:
-        if r['rango'][0] <= valor <= r['rango'][1]:
-            return r['significado']
-    return 'Interpretación no disponible'
+    # Las mismas categorías que el raster de clases de procesar_imagen
+    return CLASES_GLOSARIO[nombre].categoria(valor)
+
+# === LLM Completions ===
+# Métricas de las últimas llamadas (para ajustar LLM_MAX_TOKENS y el prompt)
+METRICAS_LLM = deque(maxlen=LLM_METRICS_ITEMS)
+
+def _registrar_llm(metricas, model, max_tokens, t0, ttft, usage, cache):
+    metricas.update(
+        modelo=model,
+        max_tokens=max_tokens,
+        cache=cache,
+        ttft=round(ttft, 4) if ttft is not None else None,
+        latencia=round(time.perf_counter() - t0, 4),
+        tokens_prompt=getattr(usage, 'prompt_tokens', None),
+        tokens_completion=getattr(usage, 'completion_tokens', None)
+    )
+    METRICAS_LLM.append(dict(metricas))
+    contar('tokens', metricas['tokens_prompt'] or 0, tipo='prompt')
+    contar('tokens', metricas['tokens_completion'] or 0, tipo='completion')
+    return metricas
+
+def metricas_llm():
+    """Copia de las métricas registradas (una por llamada a la LLM)."""
+    return list(METRICAS_LLM)
+
+def _completar(messages, temperature, max_tokens, model=LLM_MODEL):
+    # Prompts idénticos (mismo modelo y parámetros) se responden desde la
+    # caché, y los concurrentes comparten una única llamada en vuelo
+    clave = clave_hash('llm', model, temperature, max_tokens, messages)
+
+    def llamar():
+        t0 = time.perf_counter()
+        contar('llamadas_externas', servicio='llm')
+        with _limite('llm'), span('llm', modelo=model, max_tokens=max_tokens):
+            resp = get_client().chat.completions.create(
+                model=model,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                messages=messages
+            )
+        _registrar_llm({}, model, max_tokens, t0, None, resp.usage, False)
+        return resp.choices[0].message.content.strip()
+
+    return cache_llm.llamar(clave, llamar)
+
+def _completar_stream(messages, temperature, max_tokens, model=LLM_MODEL, metricas=None):
+    """
+    Como _completar, pero genera el texto a medida que llegan los tokens.
+    Al terminar, `metricas` (si se pasa un dict) queda con ttft, latencia y
+    tokens de prompt/completion; la respuesta completa se guarda en la misma
+    caché, y un hit se devuelve en un solo fragmento.
+    """
+    metricas = {} if metricas is None else metricas
+    clave = clave_hash('llm', model, temperature, max_tokens, messages)
+    t0 = time.perf_counter()
+    hit, texto = cache_llm.obtener(clave)
+    if hit:
+        _registrar_llm(metricas, model, max_tokens, t0, time.perf_counter() - t0, None, True)
+        yield texto
+        return
+
+    contar('llamadas_externas', servicio='llm')
+    partes, ttft, usage = [], None, None
+    with _limite('llm'), span('llm_stream', modelo=model, max_tokens=max_tokens):
+        stream = get_client().chat.completions.create(
+            model=model,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        for chunk in stream:
+            # El último chunk trae solo el uso de tokens (sin choices)
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if ttft is None:
+                    ttft = time.perf_counter() - t0
+                partes.append(delta)
+                yield delta
+    cache_llm.guardar(clave, "".join(partes).strip())
+    _registrar_llm(metricas, model, max_tokens, t0, ttft, usage, False)
 
 # === Explain Index via LLM ===
 def explicar_indice_llm(valor, nombre, categoria):
@@ -270,16 +835,10 @@ def explicar_indice_llm(valor, nombre, categoria):
         f"Tengo un índice {nombre} con valor {valor:.3f}, que cae en '{categoria}'. "
         "Explícalo en una frase breve, enfocándote en el estado del cultivo y posibles acciones."
     )
-    resp = client.chat.completions.create(
-        model=LLM_MODEL,
-        temperature=EXPLAIN_TEMPERATURE,
-        max_tokens=EXPLAIN_MAX_TOKENS,
-        messages=[
-            {"role":"system","content":system_prompt_llm},
-            {"role":"user","content":prompt}
-        ]
-    )
-    return resp.choices[0].message.content.strip()
+    return _completar([
+        {"role":"system","content":system_prompt_llm},
+        {"role":"user","content":prompt}
+    ], EXPLAIN_TEMPERATURE, EXPLAIN_MAX_TOKENS)
 
 # === Phenological Stage via LLM ===
 def etapa_fenologica_llm(cultivo, dias, ubicacion, clima_actual):
@@ -291,16 +850,10 @@ def etapa_fenologica_llm(cultivo, dias, ubicacion, clima_actual):
         f"desde siembra y estas condiciones: {clima_txt}, ¿en qué etapa fenológica está y por qué? "
         "Devuélvelo en una frase breve."
     )
-    resp = client.chat.completions.create(
-        model=LLM_MODEL,
-        temperature=PHENO_TEMPERATURE,
-        max_tokens=PHENO_MAX_TOKENS,
-        messages=[
-            {"role":"system","content":system_prompt_llm},
-            {"role":"user","content":user_prompt}
-        ]
-    )
-    return resp.choices[0].message.content.strip()
+    return _completar([
+        {"role":"system","content":system_prompt_llm},
+        {"role":"user","content":user_prompt}
+    ], PHENO_TEMPERATURE, PHENO_MAX_TOKENS)
 
 # === Generate Action Plan via LLM ===
 def generar_plan_accion_llm(texto_informe):
@@ -308,78 +861,244 @@ def generar_plan_accion_llm(texto_informe):
         f"A partir de este informe técnico, genera un plan de acción con sugerencias claras "
         f"y pasos a seguir para mejorar el cultivo:\n{texto_informe}\nDevuélvelo en un listado de puntos."
     )
-    resp = client.chat.completions.create(
-        model=LLM_MODEL,
-        temperature=PLAN_TEMPERATURE,
-        max_tokens=PLAN_MAX_TOKENS,
-        messages=[
-            {"role":"system","content":system_prompt_llm},
-            {"role":"user","content":prompt}
-        ]
-    )
-    return resp.choices[0].message.content.strip()
+    return _completar([
+        {"role":"system","content":system_prompt_llm},
+        {"role":"user","content":prompt}
+    ], PLAN_TEMPERATURE, PLAN_MAX_TOKENS)
 
 # === Satellite Image Processing ===
-def procesar_imagen(path):
+@etapa('raster')
+def procesar_imagen(path, indices=None, arrays=True, streaming=None,
+                    workers=None, pool=None, clases=True, memmap=None):
     """
     Abre un GeoTIFF multibanda en el orden fijo [B4, B3, B2, B8, B8A, B11]
     y calcula índices: NDVI, EVI, NDMI, NDWI, SAVI, GNDVI, NDRE, MSAVI.
-    """
-    import numpy as np
-    import rasterio
 
-    # 1) Abrir y leer todas las bandas
+    `indices` limita el cálculo a un subconjunto; `arrays` indica qué rasters
+    por píxel devolver en `funcs` (True = todos, False = ninguno, o un
+    iterable de nombres). Los arrays son float32 con NaN donde no hay dato.
+    `funcs` es perezoso (IndicesPerezosos): cada array se calcula recién al
+    pedirlo y se libera cuando el llamador lo suelta; con `memmap=True` vive
+    en un archivo temporal mapeado en lugar del heap.
+
+    Con `streaming=True` la imagen se recorre por ventanas con memoria acotada
+    y `funcs` queda vacío; con `streaming=None` se activa solo si la imagen
+    supera STREAM_PIXELS píxeles por banda. El modo streaming reparte las
+    ventanas entre `workers` hilos o procesos (`pool` = 'thread'|'process',
+    por defecto WORKERS y POOL); el resultado no depende de esa elección.
+
+    `meta['estadisticas']` trae conteo, mínimo y máximo de cada índice. Con
+    `clases=True`, `meta['clases']` trae píxeles y fracción del área por
+    categoría del glosario, y `funcs` suma el raster uint8 de categorías
+    ('<índice>_clases') de cada índice devuelto.
+    """
+    clases_sel = CLASES_GLOSARIO if clases else None
     with rasterio.open(path) as src:
-        arr = src.read(masked=True)  # arr.shape esperado: (6, filas, cols)
         meta = {'count': src.count, 'crs': src.crs, 'bounds': src.bounds}
+        if streaming is None:
+            streaming = src.width * src.height > STREAM_PIXELS
+        if not streaming:
+            # Los arrays por píxel se leen después de este mismo archivo: su
+            # handle se abre antes de leer, así no pueden venir de otra versión
+            funcs = IndicesPerezosos(path, indices, arrays, clases_sel, memmap=memmap)
+            # 1) Leer las 6 bandas en su tipo nativo (uint16 en escenas GEE)
+            crudas = BandasCrudas.leer(src)
 
-    # 2) Verificar que efectivamente hay 6 bandas
-    if arr.shape[0] < 6:
-        raise ValueError(f"Esperaba 6 bandas (B4,B3,B2,B8,B8A,B11), encontré {arr.shape[0]}")
-
-    # 3) Extraer por posición fija (índice 0→B4, 1→B3, 2→B2, 3→B8, 4→B8A, 5→B11)
-    R = arr[0]  # Rojo (B4)
-    G = arr[1]  # Verde (B3)
-    B = arr[2]  # Azul (B2)
-    N = arr[3]  # NIR (B8)
-    RE = arr[4] # Red-Edge (B8A)
-    S = arr[5]  # SWIR1 (B11)
-
-    # 4) Normalizar si vienen valores en un rango >1 (Digital Numbers)
-    maxv = max(np.nanmax(ch) for ch in (R, G, B, N, RE, S))
-    if maxv > 1:
-        R, G, B, N, RE, S = [ch / maxv for ch in (R, G, B, N, RE, S)]
-
-    # 5) Calcular índices
-    # Nota: usamos 1e-5 para evitar división por cero
-    funcs = {
-        'NDVI':  (N - R) / (N + R + 1e-5),
-        'EVI':   2.5 * (N - R) / (N + 6*R - 7.5*B + 1e-5),
-        'NDMI':  (N - S) / (N + S + 1e-5),       # humedad biomasa
-        'NDWI':  (G - N) / (G + N + 1e-5),       # verde–NIR (puedes omitirlo si solo quieres NDMI)
-        'SAVI':  1.5 * (N - R) / (N + R + 0.5 + 1e-5),
-        'GNDVI': (G - R) / (G + R + 1e-5),
-        'NDRE':  (RE - R) / (RE + R + 1e-5),     # clorofila vía red-edge
-        'MSAVI': (2*N + 1 - np.sqrt((2*N + 1)**2 - 8*(N - R))) / 2
-    }
+    if streaming:
+        # Recorrido por ventanas: sumas, conteos y mín/máx corrientes
+        acum = acumular_en_paralelo(path, indices, workers, pool, clases=clases_sel)
+        funcs = {}
+    else:
+        # 2) Normalizar si vienen valores en un rango >1 (Digital Numbers)
+        maxv = crudas.maximo()
+        escala = np.float32(maxv) if maxv > 1 else None
 
-    # 6) Calcular promedio de cada índice
-    promedios = {k: float(np.nanmean(v)) for k, v in funcs.items()}
+        # 3) Índices, promedios y categorías por franjas: cada franja pasa a
+        #    reflectancia float32 recién dentro del kernel
+        acum = Acumulador(indices, clases_sel)
+        promedios_por_franjas(crudas, indices, acum=acum, escala=escala)
+        del crudas
+        funcs.escala = escala
 
+    meta['estadisticas'] = acum.estadisticas()
+    if clases:
+        meta['clases'] = acum.fracciones()
     tipo = 'Multiespectral'
-    return promedios, funcs, tipo, meta
+    return acum.promedios(), funcs, tipo, meta
+
+@cacheado(cache_analisis, lambda escena, path: escena)
+def analizar_escena(escena, path):
+    """
+    (promedios, tipo, meta) de procesar_imagen sin arrays por píxel,
+    memoizado por `escena` (hash de la imagen subida o escena de GEE): otro
+    informe sobre la misma escena con otro cultivo o fechas no la reprocesa.
+    """
+    promedios, _, tipo, meta = procesar_imagen(path, arrays=False)
+    return promedios, tipo, meta
+
+def vista_indice(path, indice='NDVI', max_lado=None):
+    """
+    `indice` calculado solo a la resolución de pantalla (lado mayor
+    max_lado, por defecto PREVIEW_SIDE), leyendo del overview más cercano.
+    Devuelve (array float32 con NaN, bounds).
+    """
+    with rasterio.open(path) as src:
+        return vista_previa(src, (indice,), max_lado)[seleccionar_indices((indice,))[0]], src.bounds
+
+def _guardar_deltas(deltas, ref_path, descripciones, salida):
+    # int16 escalado (DELTA_ESCALA queda como scale de cada banda) en un COG
+    # sobre la grilla de la escena de referencia
+    with rasterio.open(ref_path) as ref:
+        perfil = dict(driver='GTiff', width=ref.width, height=ref.height, count=len(deltas),
+                      dtype='int16', crs=ref.crs, transform=ref.transform, nodata=DELTA_NODATA,
+                      tiled=True, blockxsize=COG_BLOCK, blockysize=COG_BLOCK)
+    fd, tmp = tempfile.mkstemp(suffix=".tif")
+    os.close(fd)
+    try:
+        with rasterio.open(tmp, 'w', **perfil) as dst:
+            dst.write(deltas)
+            dst.scales = (DELTA_ESCALA,) * len(deltas)
+            dst.descriptions = tuple(descripciones)
+        copiar_raster(tmp, salida, driver='COG', COMPRESS=COG_COMPRESS, PREDICTOR='YES',
+                      BLOCKSIZE=COG_BLOCK, OVERVIEW_RESAMPLING='AVERAGE', BIGTIFF='IF_SAFER')
+    finally:
+        os.remove(tmp)
+    return salida
+
+def detectar_cambios(lat, lon, fecha=None, indices=None, umbral=None, raster=('NDVI',),
+                     window_days=WINDOW_DAYS,
+                     max_cloud_pct=CLOUD_THRESHOLD,
+                     scale=SCALE,
+                     buffer_m=BUFFER_M):
+    """
+    Compara la escena de `fecha` (por defecto hoy) con las de ~30 días y un
+    año antes (las fechas de get_gee_image_dates). Las tres se eligen en un
+    solo getInfo y se descargan sobre la misma región, escala y CRS,
+    reutilizando las escenas ya guardadas en la caché; los índices de las
+    tres fechas se calculan y restan en una sola pasada (cambios_por_franjas).
+
+    Devuelve {'escenas': {fecha: meta_gee o None}, 'cambios': {comparación:
+    {índice: {'delta_media', 'n', 'min', 'max', 'fraccion_caida'}}},
+    'raster': COG int16 de diferencias actual − pasada de los índices de
+    `raster` (una banda por comparación e índice, ver 'bandas') o None}.
+    Una caída es significativa si la diferencia es ≤ −umbral
+    (CHANGE_THRESHOLD). Las fechas pasadas sin imagen no se comparan.
+    """
+    lat, lon = cuantizar(lat, lon)
+    fechas = _fechas_referencia(fecha)
+    sels = _selecciones_cacheadas(lat, lon, fechas, window_days, max_cloud_pct, buffer_m)
+    if sels['actual'] is None:
+        raise ValueError("No se encontró imagen Sentinel-2")
+
+    # Una descarga por imagen distinta (dos fechas pueden caer en la misma)
+    with ThreadPoolExecutor(max_workers=len(fechas)) as ex:
+        futs = {}
+        for sel in sels.values():
+            if sel and sel[1] not in futs:
+                futs[sel[1]] = en_hilo(ex, _escena_cacheada, lat, lon, sel[0], sel[1], scale, buffer_m)
+        paths = {k: futs[sel[1]].result() for k, sel in sels.items() if sel}
+
+    sel_indices = seleccionar_indices(indices)
+    raster = tuple(k for k in seleccionar_indices(raster) if k in sel_indices) if raster else ()
+    comparaciones = [k for k in paths if k != 'actual']
+    bandas = [f"{k} actual-{c}" for c in comparaciones for k in raster]
+    ruta_raster = None
+    if bandas:
+        clave = clave_hash('cambios', [sels[k][1] for k in paths], lat, lon, scale,
+                           buffer_m, raster, DELTA_ESCALA)
+        ruta_raster = cache_escenas.obtener(clave)
+    with span('cambios', fechas=len(paths)):
+        acum, deltas = cambios_por_franjas(paths, sel_indices, umbral,
+                                           raster if bandas and ruta_raster is None else ())
+    if deltas is not None:
+        ruta_raster = cache_escenas.guardar(
+            clave, lambda tmp: _guardar_deltas(deltas, paths['actual'], bandas, tmp))
+    return {
+        'escenas': {k: _meta_gee(sel, fechas[k], max_cloud_pct, scale, buffer_m) if sel else None
+                    for k, sel in sels.items()},
+        'cambios': acum.resultados(),
+        'raster': ruta_raster,
+        'bandas': bandas if ruta_raster else []
+    }
+
+@etapa('zonal')
+def estadisticas_lotes(path, lotes, id_campo='id', indices=None, clases=True):
+    """
+    Promedios, conteos y fracciones por categoría de cada lote de `lotes`
+    (FeatureCollection GeoJSON en EPSG:4326, como dict o ruta) con una sola
+    lectura de la escena: los polígonos se rasterizan una vez a un raster de
+    etiquetas alineado con la imagen y todo se acumula por etiqueta.
+    Devuelve {id_lote: {'pixeles', 'promedios', 'n', 'clases'}}; un lote
+    sin píxeles dentro de la escena queda con promedios NaN.
+    """
+    if isinstance(lotes, str):
+        with open(lotes, encoding='utf-8') as f:
+            lotes = json.load(f)
+    feats = [f for f in lotes['features'] if f.get('geometry')]
+    ids = [(f.get('properties') or {}).get(id_campo, i) for i, f in enumerate(feats, 1)]
+    with rasterio.open(path) as src:
+        etiquetas = etiquetas_zonas(src, [f['geometry'] for f in feats])
+        crudas = BandasCrudas.leer(src)
+    maxv = crudas.maximo()
+    escala = np.float32(maxv) if maxv > 1 else None
+    acum = acumular_zonas(crudas, etiquetas, len(feats), indices,
+                          CLASES_GLOSARIO if clases else None, escala)
+    return acum.resultados(ids)
 
 # === Generate Report Text ===
-def generar_informe(promedios, fecha, cultivo, ubicacion, tipo, fecha_siembra, fuente=None):
-    lat, lon = geocode_location(ubicacion)
-    imgs      = get_gee_image_dates(lat, lon)
-    clima_act = obtener_clima_current(lat, lon)
-    forecast7 = get_extended_forecast(lat, lon)
+
+def _falla_de_red(e):
+    # Timeouts y errores de conexión (requests u OpenAI, que se importa en
+    # el primer uso): el servicio no respondió, no es un error del código
+    if isinstance(e, (FuturesTimeout, TimeoutError, ConnectionError, requests.RequestException)):
+        return True
+    return any(c.__name__ == 'APIConnectionError' for c in type(e).__mro__)
+
+def _esperar(fut, t0, timeout, default, nombre=None):
+    # Resultado de `fut` si llega antes de t0 + timeout; si se demora o el
+    # servicio no responde, `default` para que el informe siga sin esa
+    # dependencia. Cualquier otro error (p. ej. falta una API key) también
+    # cae en `default`, pero queda con traceback en el log. Sin `nombre` no
+    # se registra nada (otra espera del mismo futuro ya lo reporta).
+    try:
+        return fut.result(timeout=max(0.0, t0 + timeout - time.monotonic()))
+    except Exception as e:
+        if nombre is None:
+            return default
+        contar('dependencias_fallidas', dependencia=nombre, error=type(e).__name__)
+        if _falla_de_red(e):
+            log.warning("%s no disponible: %s: %s", nombre, type(e).__name__, e)
+        else:
+            log.exception("%s falló; el informe sigue sin esa dependencia", nombre)
+        return default
+
+@etapa('informe')
+def generar_informe(promedios, fecha, cultivo, ubicacion, tipo, fecha_siembra, fuente=None,
+                    lat=None, lon=None, clases=None):
+    # Si ya se conocen las coordenadas no hace falta geocodificar
+    if lat is None or lon is None:
+        lat, lon = geocode_location(ubicacion)
     try:
         dias = (datetime.strptime(fecha, '%Y-%m-%d') - datetime.strptime(fecha_siembra, '%Y-%m-%d')).days
     except:
         dias = None
-    etapa = etapa_fenologica_llm(cultivo, dias, ubicacion, clima_act)
+
+    # Todas las consultas externas salen a la vez; cada una tiene su timeout
+    ex = ThreadPoolExecutor(max_workers=4)
+    t0 = time.monotonic()
+    fut_imgs = en_hilo(ex, get_gee_image_dates, lat, lon)
+    fut_clima = en_hilo(ex, obtener_clima_current, lat, lon)
+    fut_forecast = en_hilo(ex, get_extended_forecast, lat, lon)
+    # La etapa fenológica usa el clima actual: se encadena solo a esa consulta
+    fut_etapa = en_hilo(ex, lambda: etapa_fenologica_llm(
+        cultivo, dias, ubicacion,
+        _esperar(fut_clima, t0, WEATHER_TIMEOUT, None) or {}))
+
+    imgs      = _esperar(fut_imgs, t0, GEE_TIMEOUT, dict.fromkeys(_fechas_referencia(), (None, None, None)), 'gee')
+    clima_act = _esperar(fut_clima, t0, WEATHER_TIMEOUT, None, 'clima')
+    forecast7 = _esperar(fut_forecast, t0, WEATHER_TIMEOUT, [], 'pronostico')
+    etapa     = _esperar(fut_etapa, t0, PHENO_TIMEOUT, 'No disponible', 'fenologia')
+    ex.shutdown(wait=False, cancel_futures=True)
 
     lines = []
     if fuente:
@@ -394,6 +1113,10 @@ def generar_informe(promedios, fecha, cultivo, ubicacion, tipo, fecha_siembra, f
             continue
         cat = interpretar_indice(v, k)
         lines.append(f"{k}: {v:.3f} → {cat}")
+        # Distribución por categoría: el promedio puede ocultar zonas con estrés
+        if clases and clases.get(k):
+            partes = [f"{c['fraccion']:.0%} {nombre}" for nombre, c in clases[k].items()]
+            lines.append(f"  Distribución: {', '.join(partes)}")
     # Nota: en este paso solo incluimos la parte técnica sin explicaciones LLM.
     # El pulido/integración la haremos en el siguiente prompt.
 
@@ -426,28 +1149,96 @@ def generar_informe(promedios, fecha, cultivo, ubicacion, tipo, fecha_siembra, f
     return "\n".join(lines)
 
 # === Polish Report with LLM ===
-def generar_informe_llm(texto_informe):
+def _mensajes_informe(texto_informe):
     prompt = (
         texto_informe
         + "\n\nPor favor, genera un análisis integrando los índices de vegetación con las condiciones climáticas actuales y el pronóstico: "
           "explica cómo el clima afecta esos índices y propone recomendaciones concretas de manejo (riego, fertilización, monitoreo, etc.). "
           "Devuélvelo en español simple y profesional, con secciones claras: Resumen, Interpretación detallada, Recomendaciones."
     )
-    resp = client.chat.completions.create(
-        model=LLM_MODEL,
-        temperature=LLM_TEMPERATURE,
-        max_tokens=LLM_MAX_TOKENS,
-        messages=[
-            {"role":"system","content": system_prompt_llm},
-            {"role":"user","content": prompt}
-        ]
-    )
-    return resp.choices[0].message.content.strip()
+    return [
+        {"role":"system","content":system_prompt_llm},
+        {"role":"user","content":prompt}
+    ]
+
+def generar_informe_llm(texto_informe):
+    return _completar(_mensajes_informe(texto_informe), LLM_TEMPERATURE, LLM_MAX_TOKENS)
+
+def generar_informe_llm_stream(texto_informe, metricas=None):
+    """Versión incremental de generar_informe_llm (ver _completar_stream)."""
+    return _completar_stream(_mensajes_informe(texto_informe), LLM_TEMPERATURE, LLM_MAX_TOKENS,
+                             metricas=metricas)
 
 # === Final Orchestration ===
 def crear_reporte(path_tif, fecha, cultivo, ubicacion, fecha_siembra, fuente=None):
-    promedios, _, tipo, meta = procesar_imagen(path_tif)
-    texto_prelim = generar_informe(promedios, fecha, cultivo, ubicacion, tipo, fecha_siembra, fuente)
-    informe_final = generar_informe_llm(texto_prelim)
-    return {'informe': informe_final}
+    # 'traza' trae spans y contadores de cada etapa (None con TRAZAS=0)
+    with traza('crear_reporte') as t:
+        promedios, _, tipo, meta = procesar_imagen(path_tif, arrays=False)
+        texto_prelim = generar_informe(promedios, fecha, cultivo, ubicacion, tipo, fecha_siembra, fuente,
+                                       clases=meta.get('clases'))
+        informe_final = generar_informe_llm(texto_prelim)
+    return {'informe': informe_final, 'traza': t.a_dict() if t else None}
+
+# === Report Pipeline for Background Jobs ===
+def clave_reporte(fecha, cultivo, ubicacion, fecha_siembra, lat=None, lon=None, imagen=None,
+                  window_days=WINDOW_DAYS, max_cloud_pct=CLOUD_THRESHOLD):
+    """
+    Clave normalizada de un pedido de informe: misma localidad (sin
+    mayúsculas, acentos compuestos ni espacios extra), punto cuantizado,
+    fechas, cultivo, parámetros de GEE e imagen subida (hash) dan la misma clave.
+    """
+    punto = cuantizar(lat, lon) if lat is not None and lon is not None else None
+    return clave_hash('reporte', _clave_lugar(ubicacion or ''), punto, fecha,
+                      _clave_lugar(cultivo or ''), fecha_siembra, imagen,
+                      window_days, max_cloud_pct)
+
+def generar_reporte(avance, fecha, cultivo, ubicacion, fecha_siembra, lat=None, lon=None,
+                    path=None, fuente=None, window_days=WINDOW_DAYS, max_cloud_pct=CLOUD_THRESHOLD,
+                    imagen=None):
+    """
+    Pipeline completo de un informe para la cola de trabajos. Sin `path`
+    geocodifica (si faltan lat/lon) y descarga la escena de GEE. Publica cada
+    etapa con `avance(estado, **datos)`; el texto de la LLM se publica a
+    medida que llega ('informe'). El análisis del raster se memoiza por
+    escena (`imagen` = hash de la subida, o la escena de GEE), así que solo
+    el informe depende del cultivo y las fechas.
+    """
+    meta_gee = None
+    with traza('reporte') as t:
+        if path is None:
+            if lat is None or lon is None:
+                avance('geocodificando')
+                lat, lon = geocode_location(ubicacion)
+            avance('descargando', lat=lat, lon=lon)
+            path, meta_gee = download_gee_image(lat, lon, fecha, window_days, max_cloud_pct)
+            if not path:
+                raise ValueError("No se encontró imagen Sentinel-2")
+            fuente = f"GEE Sentinel-2: {meta_gee['actual_date']}"
+            escena = clave_hash('gee', meta_gee['image_id'], cuantizar(lat, lon),
+                                meta_gee['scale'], meta_gee['buffer_m'])
+        else:
+            escena = clave_hash('subida', imagen or path)
+        avance('procesando', ruta=path, meta_gee=meta_gee)
+        promedios, tipo, meta = analizar_escena(escena, path)
+        avance('informe_tecnico', promedios=promedios, meta=meta)
+        texto = generar_informe(promedios, fecha, cultivo, ubicacion, tipo, fecha_siembra, fuente,
+                                lat=lat, lon=lon, clases=meta.get('clases'))
+        avance('llm', texto_tecnico=texto)
+        partes, metricas = [], {}
+        for delta in generar_informe_llm_stream(texto, metricas):
+            partes.append(delta)
+            avance('llm', informe="".join(partes))
+    return {
+        'ruta': path,
+        'meta_gee': meta_gee,
+        'fuente': fuente,
+        'promedios': promedios,
+        'tipo': tipo,
+        'meta': meta,
+        'texto_tecnico': texto,
+        'informe': "".join(partes).strip(),
+        'metricas_llm': metricas,
+        'traza': t.a_dict() if t else None
+    }
 
+TIEMPOS_INICIO['import'] = time.perf_counter() - _T0_IMPORT
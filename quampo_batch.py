@@ -0,0 +1,268 @@
+import os
+import csv
+import sys
+import json
+import math
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from datetime import datetime
+
+from quampo_backend import (
+    download_gee_image,
+    generar_informe,
+    generar_informe_llm,
+    geocode_location,
+    procesar_imagen,
+    promedios_gee,
+    set_limites
+)
+from quampo_cache import clave_hash
+from quampo_traza import traza
+
+# === Modo lote: reanálisis de todo el portafolio ===
+# Uso: python quampo_batch.py campos.csv resultados.jsonl [--workers 16 ...]
+# Cada campo necesita 'cultivo', 'fecha_siembra' y 'ubicacion' o 'lat'/'lon'
+# (en GeoJSON, las coordenadas salen de la geometría). El JSONL de salida es
+# también el checkpoint: al reanudar se saltean los campos ya terminados.
+# Con --servidor los promedios se calculan en Earth Engine (sin descargar
+# el raster ni categorías por píxel).
+
+ETAPAS = ('geocode', 'descarga', 'raster', 'informe', 'llm')
+
+# Concurrencia máxima por servicio externo y de la etapa de CPU (via env
+# vars o flags). Los límites de servicios se aplican en cada llamada del
+# backend, así cuentan también las que generar_informe hace por dentro
+# (clima, pronóstico, etapa fenológica, fechas de GEE).
+BATCH_WORKERS   = int(os.getenv("BATCH_WORKERS",   16))
+BATCH_MAX_GEO   = int(os.getenv("BATCH_MAX_GEO",    4))
+BATCH_MAX_GEE   = int(os.getenv("BATCH_MAX_GEE",    4))
+BATCH_MAX_CLIMA = int(os.getenv("BATCH_MAX_CLIMA",  4))
+BATCH_MAX_CPU   = int(os.getenv("BATCH_MAX_CPU",    os.cpu_count() or 1))
+BATCH_MAX_LLM   = int(os.getenv("BATCH_MAX_LLM",    4))
+
+
+# === Lectura de campos ===
+def _centro(geom):
+    # Punto representativo: el punto mismo o el promedio del anillo exterior
+    tipo, coords = geom['type'], geom['coordinates']
+    if tipo == 'Point':
+        return coords[1], coords[0]
+    if tipo == 'MultiPolygon':
+        coords = coords[0]
+    if tipo in ('Polygon', 'MultiPolygon'):
+        anillo = coords[0][:-1] or coords[0]
+        return (sum(p[1] for p in anillo) / len(anillo),
+                sum(p[0] for p in anillo) / len(anillo))
+    raise ValueError(f"Geometría no soportada: {tipo}")
+
+
+def leer_campos(path):
+    """Lee los campos de un CSV o GeoJSON como lista de dicts."""
+    if path.lower().endswith(('.geojson', '.json')):
+        with open(path, encoding='utf-8') as f:
+            fc = json.load(f)
+        campos = []
+        for feat in fc['features']:
+            campo = dict(feat.get('properties') or {})
+            if feat.get('geometry'):
+                campo['lat'], campo['lon'] = _centro(feat['geometry'])
+            campos.append(campo)
+    else:
+        with open(path, newline='', encoding='utf-8') as f:
+            campos = [dict(r) for r in csv.DictReader(f)]
+
+    for campo in campos:
+        for k in ('lat', 'lon'):
+            campo[k] = float(campo[k]) if campo.get(k) not in (None, '') else None
+        if not campo.get('id'):
+            campo['id'] = clave_hash(campo.get('ubicacion'), campo['lat'], campo['lon'],
+                                     campo.get('cultivo'), campo.get('fecha_siembra'))[:16]
+        campo['id'] = str(campo['id'])
+    return campos
+
+
+def _reparar_cola(salida):
+    # Una corrida interrumpida puede dejar la última línea a medias (incluso
+    # cortada dentro de un carácter UTF-8): se recorta hasta el último '\n'
+    if not os.path.exists(salida):
+        return
+    with open(salida, 'rb+') as f:
+        fin = f.seek(0, os.SEEK_END)
+        inicio = fin
+        while inicio > 0:
+            bloque = max(0, inicio - (1 << 16))
+            f.seek(bloque)
+            datos = f.read(inicio - bloque)
+            corte = datos.rfind(b"\n")
+            if corte >= 0:
+                inicio = bloque + corte + 1
+                break
+            inicio = bloque
+        if inicio < fin:
+            f.truncate(inicio)
+
+
+def _terminados(salida):
+    # Ids con estado 'ok' en el JSONL existente (los errores se reintentan).
+    # Cada línea se decodifica por separado: una línea dañada no corta la lectura
+    if not os.path.exists(salida):
+        return set()
+    ids = set()
+    with open(salida, 'rb') as f:
+        for linea in f:
+            try:
+                r = json.loads(linea.decode('utf-8', errors='replace'))
+            except ValueError:
+                continue
+            if isinstance(r, dict) and r.get('estado') == 'ok':
+                ids.add(r['id'])
+    return ids
+
+
+# === Pipeline por campo ===
+class _Etapas:
+    """Latencias registradas por etapa y semáforos de las etapas locales (CPU)."""
+
+    def __init__(self, limites):
+        self.sem = {k: threading.BoundedSemaphore(v) for k, v in limites.items()}
+        self.tiempos = {k: [] for k in ETAPAS}
+        self._lock = threading.Lock()
+
+    def correr(self, etapa, tiempos_campo, fn, *args, **kwargs):
+        with self.sem.get(etapa) or nullcontext():
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                dt = time.perf_counter() - t0
+                tiempos_campo[etapa] = round(dt, 4)
+                with self._lock:
+                    self.tiempos[etapa].append(dt)
+
+
+def procesar_campo(campo, etapas, servidor=False):
+    with traza('campo') as t:
+        res = _procesar_campo(campo, etapas, servidor)
+    if t is not None:
+        res['traza'] = t.a_dict()
+    return res
+
+
+def _procesar_campo(campo, etapas, servidor):
+    tiempos = {}
+    fecha = campo.get('fecha') or datetime.utcnow().date().isoformat()
+    ubicacion = campo.get('ubicacion') or ''
+    res = {'id': campo['id'], 'ubicacion': ubicacion, 'cultivo': campo.get('cultivo'),
+           'fecha': fecha, 'tiempos': tiempos}
+    try:
+        lat, lon = campo['lat'], campo['lon']
+        if lat is None or lon is None:
+            lat, lon = etapas.correr('geocode', tiempos, geocode_location, ubicacion)
+        res.update(lat=lat, lon=lon)
+
+        if servidor:
+            promedios, meta_gee = etapas.correr('descarga', tiempos, promedios_gee, lat, lon, fecha)
+            tipo, meta = 'Multiespectral', {}
+        else:
+            ruta, meta_gee = etapas.correr('descarga', tiempos, download_gee_image, lat, lon, fecha)
+            if ruta:
+                promedios, _, tipo, meta = etapas.correr('raster', tiempos, procesar_imagen, ruta, arrays=False)
+        if not meta_gee:
+            raise ValueError("No se encontró imagen Sentinel-2")
+        fuente = f"GEE Sentinel-2: {meta_gee['actual_date']}"
+        texto = etapas.correr('informe', tiempos, generar_informe,
+                              promedios, fecha, campo.get('cultivo'), ubicacion or f"{lat:.4f},{lon:.4f}",
+                              tipo, campo.get('fecha_siembra'), fuente, lat=lat, lon=lon,
+                              clases=meta.get('clases'))
+        informe = etapas.correr('llm', tiempos, generar_informe_llm, texto)
+        res.update(estado='ok', promedios=promedios, clases=meta.get('clases'), meta_gee=meta_gee,
+                   informe_tecnico=texto, informe=informe)
+    except Exception as e:
+        res.update(estado='error', error=f"{type(e).__name__}: {e}")
+    return res
+
+
+# === Ejecución del lote ===
+def percentil(valores, p):
+    """Percentil p (0–100) por rango más cercano."""
+    if not valores:
+        return None
+    orden = sorted(valores)
+    return orden[max(0, math.ceil(p / 100 * len(orden)) - 1)]
+
+
+def ejecutar_lote(campos, salida, workers=None, limites=None, servidor=False):
+    """
+    Procesa `campos` con concurrencia acotada por servicio y agrega cada
+    resultado como una línea de `salida` (JSONL). `limites` acota los
+    servicios ('geocode', 'gee', 'clima', 'llm') y la etapa 'raster'.
+    Devuelve el resumen con throughput y percentiles de latencia por etapa.
+    """
+    limites = {'geocode': BATCH_MAX_GEO, 'gee': BATCH_MAX_GEE, 'clima': BATCH_MAX_CLIMA,
+               'llm': BATCH_MAX_LLM, 'raster': BATCH_MAX_CPU, **(limites or {})}
+    etapas = _Etapas({'raster': limites.pop('raster')})
+    _reparar_cola(salida)
+    hechos = _terminados(salida)
+    pendientes = [c for c in campos if c['id'] not in hechos]
+
+    conteo = {'ok': 0, 'error': 0}
+    t0 = time.perf_counter()
+    anteriores = set_limites(limites)
+    try:
+        with open(salida, 'a', encoding='utf-8') as out, \
+                ThreadPoolExecutor(max_workers=workers or BATCH_WORKERS) as ex:
+            futs = [ex.submit(procesar_campo, c, etapas, servidor) for c in pendientes]
+            # Cada campo se escribe apenas termina: el archivo es el checkpoint
+            for fut in as_completed(futs):
+                res = fut.result()
+                out.write(json.dumps(res, ensure_ascii=False, default=str) + "\n")
+                out.flush()
+                conteo[res['estado']] += 1
+    finally:
+        set_limites(anteriores)
+    dt = time.perf_counter() - t0
+
+    return {
+        'campos': len(campos),
+        'salteados': len(campos) - len(pendientes),
+        'ok': conteo['ok'],
+        'error': conteo['error'],
+        'segundos': round(dt, 2),
+        'campos_por_min': round(len(pendientes) / dt * 60, 2) if dt > 0 else None,
+        'latencias': {
+            k: {f"p{p}": round(percentil(v, p), 4) for p in (50, 90, 99)}
+            for k, v in etapas.tiempos.items() if v
+        }
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reanálisis por lote de campos con Quampo")
+    parser.add_argument('campos', help="CSV o GeoJSON de campos")
+    parser.add_argument('salida', help="JSONL de resultados (también sirve de checkpoint)")
+    parser.add_argument('--workers', type=int, default=BATCH_WORKERS)
+    parser.add_argument('--max-geocode', type=int, default=BATCH_MAX_GEO)
+    parser.add_argument('--max-gee', type=int, default=BATCH_MAX_GEE)
+    parser.add_argument('--max-clima', type=int, default=BATCH_MAX_CLIMA)
+    parser.add_argument('--max-cpu', type=int, default=BATCH_MAX_CPU)
+    parser.add_argument('--max-llm', type=int, default=BATCH_MAX_LLM)
+    parser.add_argument('--servidor', action='store_true',
+                        help="promedios calculados en Earth Engine, sin descargar el raster")
+    args = parser.parse_args(argv)
+
+    resumen = ejecutar_lote(
+        leer_campos(args.campos), args.salida, args.workers,
+        {'geocode': args.max_geocode, 'gee': args.max_gee, 'clima': args.max_clima,
+         'llm': args.max_llm, 'raster': args.max_cpu},
+        servidor=args.servidor
+    )
+    json.dump(resumen, sys.stdout, indent=2, ensure_ascii=False)
+    print()
+    return 0 if resumen['error'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,399 @@
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import argparse
+import platform
+import tempfile
+import resource
+import statistics
+import multiprocessing
+from types import SimpleNamespace
+from unittest import mock
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+import quampo_backend as qb
+from quampo_indices import BANDAS
+
+# === Benchmark offline del pipeline ===
+# Uso: python quampo_bench.py resultados.json [--base base.json] [--tamanos 256 1024 ...]
+# Genera GeoTIFFs sintéticos de 6 bandas y mide descarga (ZIP servido
+# localmente), procesar_imagen, generar_informe y la LLM. Earth Engine,
+# OpenWeather, Google Geocoding y OpenAI se reemplazan por dobles locales con
+# latencia configurable. Cada caso corre en un proceso nuevo para medir su
+# pico de RSS. Con --base, compara contra resultados anteriores y termina
+# con código 1 si alguna etapa empeoró más que --tolerancia.
+
+BENCH_SIZES   = tuple(int(x) for x in os.getenv("BENCH_SIZES", "256,1024,4096,10980").split(","))
+BENCH_DTYPES  = tuple(os.getenv("BENCH_DTYPES", "uint16,float32").split(","))
+BENCH_REPS    = int(os.getenv("BENCH_REPS", 3))
+BENCH_TOL     = float(os.getenv("BENCH_TOL", 0.10))   # regresión tolerada (fracción)
+
+# Latencias (segundos) inyectadas por los dobles de cada servicio
+LATENCIAS = {'gee': 0.3, 'geocode': 0.05, 'clima': 0.1, 'llm': 1.5, 'descarga': 0.2}
+
+TILE = 512  # bloque de los GeoTIFF sintéticos
+
+
+# === GeoTIFF sintético ===
+def _escala(dtype):
+    # Reflectancia máxima representable en el dtype (0–1 en flotantes)
+    if np.issubdtype(np.dtype(dtype), np.floating):
+        return 1.0
+    return min(10000, np.iinfo(dtype).max)
+
+
+def generar_tif(path, lado, dtype='uint16', semilla=0):
+    """
+    Escribe un GeoTIFF de 6 bandas (B4,B3,B2,B8,B8A,B11) de lado×lado
+    píxeles, por bloques de TILE. Los valores imitan un lote con vegetación
+    variable y son reproducibles para la misma `semilla`.
+    """
+    escala = _escala(dtype)
+    perfil = dict(driver='GTiff', width=lado, height=lado, count=6, dtype=dtype,
+                  crs='EPSG:4326', transform=from_origin(-60.0, -34.0, 1e-4, 1e-4))
+    if lado >= TILE:
+        perfil.update(tiled=True, blockxsize=TILE, blockysize=TILE)
+    if lado * lado * 6 * np.dtype(dtype).itemsize > 3_900_000_000:
+        perfil['BIGTIFF'] = 'YES'
+    # Reflectancia base por banda para suelo y vegetación densa
+    suelo = np.array([0.20, 0.16, 0.12, 0.28, 0.30, 0.32], np.float32)[:, None, None]
+    veget = np.array([0.04, 0.08, 0.03, 0.45, 0.40, 0.18], np.float32)[:, None, None]
+    with rasterio.open(path, 'w', **perfil) as dst:
+        for fila in range(0, lado, TILE):
+            for col in range(0, lado, TILE):
+                h, w = min(TILE, lado - fila), min(TILE, lado - col)
+                rng = np.random.default_rng((semilla, fila, col))
+                yy, xx = np.mgrid[fila:fila + h, col:col + w].astype(np.float32) / lado
+                cobertura = np.clip(0.5 + 0.4 * np.sin(6 * xx) * np.cos(4 * yy), 0, 1)
+                refl = suelo + (veget - suelo) * cobertura
+                refl += rng.normal(0, 0.01, refl.shape).astype(np.float32)
+                refl = np.clip(refl, 0, 1) * escala
+                dst.write(refl.astype(dtype), window=Window(col, fila, w, h))
+    return path
+
+
+def _zip_bandas(path_tif, path_zip):
+    # Mismo formato que devuelve GEE: un GeoTIFF por banda dentro de un ZIP
+    d = tempfile.mkdtemp(dir=os.path.dirname(path_zip))
+    try:
+        with rasterio.open(path_tif) as src:
+            perfil = src.profile.copy()
+            perfil.update(count=1)
+            with zipfile.ZipFile(path_zip, 'w', zipfile.ZIP_STORED, allowZip64=True) as z:
+                for i, banda in enumerate(BANDAS, 1):
+                    ruta = os.path.join(d, f"download.{banda}.tif")
+                    with rasterio.open(ruta, 'w', **perfil) as dst:
+                        for _, w in src.block_windows(1):
+                            dst.write(src.read(i, window=w), 1, window=w)
+                    z.write(ruta, os.path.basename(ruta))
+                    os.remove(ruta)
+    finally:
+        shutil.rmtree(d, ignore_errors=True)
+    return path_zip
+
+
+# === Dobles locales de los servicios externos ===
+class _Respuesta:
+    def __init__(self, datos=None, archivo=None, status_code=200):
+        self.status_code = status_code
+        self._datos = datos
+        self._archivo = archivo
+
+    def json(self):
+        return self._datos
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size=1 << 20):
+        with open(self._archivo, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def _http_falso(latencias, zip_path=None):
+    def get(url, *args, **kwargs):
+        if 'geocode' in url:
+            time.sleep(latencias['geocode'])
+            return _Respuesta({'status': 'OK', 'results': [
+                {'geometry': {'location': {'lat': -33.89, 'lng': -60.57}}}]})
+        if 'onecall' in url:
+            time.sleep(latencias['clima'])
+            return _Respuesta({'daily': [
+                {'dt': 1_700_000_000 + 86400 * i, 'weather': [{'description': 'cielo claro'}],
+                 'temp': {'day': 24.0 + i}, 'rain': 0} for i in range(8)]})
+        if 'openweathermap' in url:
+            time.sleep(latencias['clima'])
+            return _Respuesta({'weather': [{'description': 'cielo claro'}],
+                               'main': {'temp': 24.0, 'humidity': 55}})
+        time.sleep(latencias['descarga'])
+        return _Respuesta(archivo=zip_path)
+    return get
+
+
+class _ObjetoEE:
+    """Cualquier objeto de ee: encadena llamadas sin hacer nada."""
+
+    def __getattr__(self, nombre):
+        return self
+
+    def __call__(self, *a, **k):
+        return self
+
+
+class _DiccionarioEE(_ObjetoEE):
+    # Solo lo que consume _seleccionar_imagenes: región y una imagen por fecha
+    def __init__(self, latencia, datos=None):
+        self._latencia = latencia
+        self._datos = datos if isinstance(datos, dict) else {}
+
+    def getInfo(self):
+        time.sleep(self._latencia)
+        imagenes = self._datos.get('imagenes')
+        claves = imagenes._datos if isinstance(imagenes, _DiccionarioEE) else {}
+        return {
+            'region': [[[-60.6, -33.9], [-60.5, -33.9], [-60.5, -33.8], [-60.6, -33.8], [-60.6, -33.9]]],
+            'imagenes': {k: {'hay': True, 'en_ventana': True, 'id': 'COPERNICUS/S2_SR/BENCH',
+                             'ts': 1_700_000_000_000} for k in claves}
+        }
+
+
+class _ImagenEE(_ObjetoEE):
+    def __init__(self, latencia):
+        self._latencia = latencia
+
+    def getDownloadURL(self, *a):
+        time.sleep(self._latencia)
+        return 'https://bench.local/zip'
+
+
+def _ee_falso(latencia):
+    ee = _ObjetoEE()
+    ee.__dict__['Dictionary'] = lambda datos=None: _DiccionarioEE(latencia, datos)
+    ee.__dict__['Image'] = lambda *a: _ImagenEE(latencia)
+    return ee
+
+
+def _llm_falso(latencia, tokens=400):
+    texto = ["palabra "] * tokens
+
+    def create(stream=False, **kwargs):
+        uso = SimpleNamespace(prompt_tokens=len(str(kwargs.get('messages'))) // 4,
+                              completion_tokens=tokens)
+        if not stream:
+            time.sleep(latencia)
+            msg = SimpleNamespace(content="".join(texto))
+            return SimpleNamespace(choices=[SimpleNamespace(message=msg)], usage=uso)
+
+        def chunks():
+            # ~20% de la latencia hasta el primer token, el resto repartido
+            time.sleep(latencia * 0.2)
+            for t in texto:
+                time.sleep(latencia * 0.8 / tokens)
+                yield SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=t))])
+            yield SimpleNamespace(usage=uso, choices=[])
+        return chunks()
+
+    return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+def instalar_dobles(latencias, zip_path=None):
+    """
+    Reemplaza Earth Engine, OpenAI y las llamadas HTTP del backend por dobles
+    locales y vacía las cachés en memoria. Devuelve el parche de HTTP (ya
+    iniciado) para poder detenerlo.
+    """
+    for k in ('GOOGLE_MAPS_API_KEY', 'OPENWEATHER_API_KEY'):
+        os.environ.setdefault(k, 'bench')
+    qb.set_ee(_ee_falso(latencias['gee']))
+    qb.set_client(_llm_falso(latencias['llm']))
+    for cache in (qb.cache_geocode, qb.cache_clima, qb.cache_forecast, qb.cache_llm):
+        cache.limpiar()
+    parche = mock.patch.object(qb, '_sesion', SimpleNamespace(get=_http_falso(latencias, zip_path)))
+    parche.start()
+    return parche
+
+
+# === Medición ===
+def _rss_mb():
+    # Pico de RSS del proceso (ru_maxrss está en KB en Linux y en bytes en macOS)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1 << 20 if sys.platform == 'darwin' else 1 << 10), 1)
+
+
+def _medir(tiempos, etapa, fn, *args, **kwargs):
+    t0 = time.perf_counter()
+    res = fn(*args, **kwargs)
+    tiempos.setdefault(etapa, []).append(time.perf_counter() - t0)
+    return res
+
+
+def _resumen(tiempos):
+    return {k: {'mediana': round(statistics.median(v), 4), 'min': round(min(v), 4)}
+            for k, v in tiempos.items()}
+
+
+def caso_raster(lado, dtype, directorio, repeticiones, latencias):
+    """Descarga (ZIP local) y procesar_imagen de un GeoTIFF de lado×lado."""
+    tiempos = {}
+    src = os.path.join(directorio, f"bench_{lado}_{dtype}.tif")
+    _medir(tiempos, 'generar', generar_tif, src, lado, dtype)
+    zip_path = _zip_bandas(src, src[:-4] + ".zip")
+    os.remove(src)
+    parche = instalar_dobles(latencias, zip_path)
+    try:
+        for _ in range(repeticiones):
+            salida = os.path.join(directorio, f"stack_{lado}_{dtype}.tif")
+            _medir(tiempos, 'descarga', qb.download_and_stack_gee_tif, 'https://bench.local/zip', salida)
+            _medir(tiempos, 'raster', qb.procesar_imagen, salida, arrays=False)
+            os.remove(salida)
+    finally:
+        parche.stop()
+        os.remove(zip_path)
+    res = _resumen(tiempos)
+    pixeles = lado * lado
+    return {
+        'caso': f"{lado}x{lado}/{dtype}",
+        'lado': lado,
+        'dtype': dtype,
+        'pixeles': pixeles,
+        'etapas': res,
+        'mpx_s': round(pixeles / 1e6 / res['raster']['mediana'], 2),
+        'rss_mb': _rss_mb()
+    }
+
+
+def caso_servicios(repeticiones, latencias):
+    """Geocodificación, generar_informe y LLM (completa y en streaming) con dobles."""
+    tiempos, ttft = {}, []
+    promedios = {'NDVI': 0.61, 'EVI': 0.42, 'NDMI': 0.18}
+    for _ in range(repeticiones):
+        parche = instalar_dobles(latencias)   # cachés vacías en cada repetición
+        try:
+            lat, lon = _medir(tiempos, 'geocode', qb.geocode_location, 'Pergamino, Buenos Aires')
+            texto = _medir(tiempos, 'informe', qb.generar_informe, promedios, '2024-01-15', 'Maíz',
+                           'Pergamino', 'Multiespectral', '2023-10-01', lat=lat, lon=lon)
+            _medir(tiempos, 'llm', qb.generar_informe_llm, texto + " (completo)")
+            metricas = {}
+            _medir(tiempos, 'llm_stream', lambda: list(qb.generar_informe_llm_stream(texto, metricas)))
+            ttft.append(metricas['ttft'])
+        finally:
+            parche.stop()
+    return {
+        'caso': 'servicios',
+        'etapas': _resumen(tiempos),
+        'llm_ttft': round(statistics.median(ttft), 4),
+        'rss_mb': _rss_mb()
+    }
+
+
+def _en_proceso(fn, *args):
+    # Un proceso nuevo por caso: el pico de RSS queda aislado
+    with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+        return pool.apply(fn, args)
+
+
+def ejecutar(tamanos=None, dtypes=None, repeticiones=None, latencias=None, directorio=None):
+    """Corre todos los casos y devuelve el resultado como dict serializable."""
+    latencias = {**LATENCIAS, **(latencias or {})}
+    repeticiones = repeticiones or BENCH_REPS
+    temporal = directorio is None
+    directorio = directorio or tempfile.mkdtemp(prefix="quampo_bench_")
+    try:
+        casos = [_en_proceso(caso_servicios, repeticiones, latencias)]
+        for lado in tamanos or BENCH_SIZES:
+            for dtype in dtypes or BENCH_DTYPES:
+                casos.append(_en_proceso(caso_raster, lado, dtype, directorio, repeticiones, latencias))
+                print(f"{casos[-1]['caso']}: {casos[-1]['mpx_s']} Mpx/s, "
+                      f"pico {casos[-1]['rss_mb']} MB", file=sys.stderr)
+    finally:
+        if temporal:
+            shutil.rmtree(directorio, ignore_errors=True)
+    return {
+        'fecha': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'entorno': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'rasterio': rasterio.__version__,
+            'gdal': rasterio.__gdal_version__,
+            'cpus': os.cpu_count(),
+            'plataforma': platform.platform(),
+            'inicio_s': {k: round(v, 4) for k, v in qb.TIEMPOS_INICIO.items()}
+        },
+        'config': {'repeticiones': repeticiones, 'latencias': latencias},
+        'casos': casos
+    }
+
+
+def comparar(actual, base, tolerancia=None):
+    """
+    Compara la mediana de cada etapa contra `base` (otro resultado de
+    `ejecutar`). Devuelve filas (caso, etapa, base, actual, cambio, regresion).
+    """
+    tolerancia = BENCH_TOL if tolerancia is None else tolerancia
+    previos = {c['caso']: c for c in base['casos']}
+    filas = []
+    for c in actual['casos']:
+        p = previos.get(c['caso'])
+        if p is None:
+            continue
+        for etapa, t in c['etapas'].items():
+            if etapa == 'generar' or etapa not in p['etapas']:
+                continue
+            t0, t1 = p['etapas'][etapa]['mediana'], t['mediana']
+            cambio = (t1 - t0) / t0 if t0 > 0 else 0.0
+            filas.append((c['caso'], etapa, t0, t1, round(cambio, 4), cambio > tolerancia))
+    return filas
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark offline del pipeline de Quampo")
+    parser.add_argument('salida', help="JSON de resultados")
+    parser.add_argument('--base', help="resultados anteriores para comparar")
+    parser.add_argument('--tamanos', type=int, nargs='+', default=BENCH_SIZES)
+    parser.add_argument('--dtypes', nargs='+', default=BENCH_DTYPES)
+    parser.add_argument('--repeticiones', type=int, default=BENCH_REPS)
+    parser.add_argument('--tolerancia', type=float, default=BENCH_TOL)
+    parser.add_argument('--latencia', nargs='*', default=[], metavar='SERVICIO=SEG',
+                        help=f"latencias inyectadas ({', '.join(LATENCIAS)})")
+    args = parser.parse_args(argv)
+
+    latencias = {}
+    for par in args.latencia:
+        k, v = par.split('=')
+        if k not in LATENCIAS:
+            parser.error(f"servicio desconocido: {k}")
+        latencias[k] = float(v)
+
+    resultado = ejecutar(args.tamanos, args.dtypes, args.repeticiones, latencias)
+    with open(args.salida, 'w', encoding='utf-8') as f:
+        json.dump(resultado, f, indent=2, ensure_ascii=False)
+
+    if not args.base:
+        return 0
+    with open(args.base, encoding='utf-8') as f:
+        base = json.load(f)
+    filas = comparar(resultado, base, args.tolerancia)
+    for caso, etapa, t0, t1, cambio, regresion in filas:
+        marca = "  REGRESIÓN" if regresion else ""
+        print(f"{caso:>22} {etapa:<10} {t0:9.4f}s → {t1:9.4f}s ({cambio:+.1%}){marca}")
+    return 1 if any(f[-1] for f in filas) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
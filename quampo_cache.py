@@ -0,0 +1,270 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import functools
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from quampo_traza import contar
+
+# === Configuración de caché (via env vars) ===
+CACHE_DIR     = os.getenv("CACHE_DIR", os.path.join(tempfile.gettempdir(), "quampo_cache"))
+CACHE_MAX_MB  = int(os.getenv("CACHE_MAX_MB", 2048))
+CACHE_QUANTUM = float(os.getenv("CACHE_QUANTUM", 1e-4))  # grados (~11 m)
+CACHE_MAX_ITEMS = int(os.getenv("CACHE_MAX_ITEMS", 4096))  # entradas por caché en memoria
+CACHE_GRACIA  = float(os.getenv("CACHE_GRACIA", 300))  # s sin podar una entrada recién usada
+
+
+def clave_hash(*partes):
+    """Clave estable (sha256) a partir de valores serializables a JSON."""
+    crudo = json.dumps(partes, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(crudo.encode('utf-8')).hexdigest()
+
+
+def cuantizar(lat, lon, paso=None):
+    """Redondea un punto a la grilla de `paso` grados para compartir entradas."""
+    paso = paso or CACHE_QUANTUM
+    return round(round(lat / paso) * paso, 7), round(round(lon / paso) * paso, 7)
+
+
+# === Caché de escenas en disco ===
+class CacheEscenas:
+    """
+    Caché en disco de escenas descargadas, direccionada por contenido.
+
+    Las escrituras son atómicas (archivo temporal + os.replace en el mismo
+    directorio), así varios workers pueden compartir el directorio. El uso
+    se marca con el atime (el mtime queda como el de la escritura, así quien
+    tenga una escena abierta puede distinguir un uso de una reescritura) y,
+    al superar `max_bytes`, se eliminan primero las entradas usadas hace más
+    tiempo. Las usadas o publicadas hace menos
+    de CACHE_GRACIA segundos (por este u otro worker) no se podan, así la
+    ruta que devuelven `obtener` y `guardar` sigue existiendo mientras el
+    llamador la abre, aunque el directorio quede un rato sobre el límite.
+    """
+
+    def __init__(self, directorio=None, max_bytes=None, nombre='escenas'):
+        self.nombre = nombre
+        self.directorio = directorio or CACHE_DIR
+        self.max_bytes = CACHE_MAX_MB << 20 if max_bytes is None else max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.directorio, exist_ok=True)
+
+    def _ruta(self, clave, ext):
+        return os.path.join(self.directorio, clave + ext)
+
+    def _contar(self, hit):
+        contar('cache', cache=self.nombre, resultado='hit' if hit else 'miss')
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def obtener(self, clave, ext='.tif'):
+        """Ruta de la entrada si existe (y la marca como usada), o None."""
+        ruta = self._ruta(clave, ext)
+        try:
+            _marcar_uso(ruta)
+        except FileNotFoundError:
+            self._contar(False)
+            return None
+        self._contar(True)
+        return ruta
+
+    def guardar(self, clave, escribir, ext='.tif'):
+        """
+        Llama a `escribir(ruta_temporal)` y publica el resultado en forma
+        atómica bajo `clave`. Devuelve la ruta final.
+        """
+        ruta = self._ruta(clave, ext)
+        fd, tmp = tempfile.mkstemp(dir=self.directorio, suffix='.part')
+        os.close(fd)
+        try:
+            escribir(tmp)
+            os.replace(tmp, ruta)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self._podar(proteger=ruta)
+        return ruta
+
+    def leer_json(self, clave, ttl):
+        """Valor JSON guardado hace menos de `ttl` segundos, o None."""
+        ruta = self.obtener(clave, '.json')
+        if ruta is None:
+            return None
+        try:
+            with open(ruta, encoding='utf-8') as f:
+                entrada = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entrada['t'] > ttl:
+            return None
+        return entrada['valor']
+
+    def guardar_json(self, clave, valor):
+        def escribir(tmp):
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({'t': time.time(), 'valor': valor}, f, ensure_ascii=False)
+        return self.guardar(clave, escribir, '.json')
+
+    def _podar(self, proteger=None):
+        # LRU por atime; los .part de más de un día son restos de workers caídos.
+        # `proteger` (lo recién publicado) y lo usado dentro de la gracia
+        # cuentan para el total pero no se borran.
+        entradas, total, ahora = [], 0, time.time()
+        for e in os.scandir(self.directorio):
+            try:
+                st = e.stat()
+            except FileNotFoundError:
+                continue
+            if e.name.endswith('.part'):
+                if ahora - st.st_mtime > 86400:
+                    _borrar(e.path)
+                continue
+            total += st.st_size
+            if e.path != proteger and ahora - st.st_atime >= CACHE_GRACIA:
+                entradas.append((st.st_atime, st.st_size, e.path))
+        if total <= self.max_bytes:
+            return
+        for _, tam, ruta in sorted(entradas):
+            _borrar(ruta)
+            total -= tam
+            if total <= self.max_bytes:
+                break
+
+    def estadisticas(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+# === Caché TTL en memoria (con respaldo opcional en disco) ===
+class CacheTTL:
+    """
+    LRU en memoria con vencimiento `ttl` (segundos) y, opcionalmente, un
+    CacheEscenas compartido como segundo nivel para valores JSON. Las
+    llamadas concurrentes con la misma clave se resuelven con una sola
+    ejecución (ver `llamar`).
+    """
+
+    def __init__(self, ttl, max_items=None, disco=None, nombre='consultas'):
+        self.nombre = nombre
+        self.ttl = ttl
+        self.max_items = max_items or CACHE_MAX_ITEMS
+        self.disco = disco
+        self.hits = 0
+        self.misses = 0
+        self._datos = OrderedDict()   # clave -> (vence, valor)
+        self._en_curso = {}           # clave -> Future de la llamada en vuelo
+        self._lock = threading.Lock()
+
+    def obtener(self, clave):
+        """Devuelve (hit, valor)."""
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is not None:
+                if entrada[0] > time.monotonic():
+                    self._datos.move_to_end(clave)
+                    self.hits += 1
+                    contar('cache', cache=self.nombre, resultado='hit')
+                    return True, entrada[1]
+                del self._datos[clave]
+        if self.disco is not None:
+            valor = self.disco.leer_json(clave, self.ttl)
+            if valor is not None:
+                self._recordar(clave, valor)
+                with self._lock:
+                    self.hits += 1
+                contar('cache', cache=self.nombre, resultado='hit')
+                return True, valor
+        with self._lock:
+            self.misses += 1
+        contar('cache', cache=self.nombre, resultado='miss')
+        return False, None
+
+    def _recordar(self, clave, valor):
+        with self._lock:
+            self._datos[clave] = (time.monotonic() + self.ttl, valor)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_items:
+                self._datos.popitem(last=False)
+
+    def guardar(self, clave, valor):
+        self._recordar(clave, valor)
+        if self.disco is not None:
+            self.disco.guardar_json(clave, valor)
+
+    def llamar(self, clave, fn, cachear=None):
+        """
+        Valor en caché para `clave` o el resultado de `fn()`. Si ya hay una
+        llamada en vuelo con la misma clave, espera ese resultado en lugar de
+        repetirla. `cachear(valor)` decide si el resultado se guarda.
+        """
+        hit, valor = self.obtener(clave)
+        if hit:
+            return valor
+        with self._lock:
+            fut = self._en_curso.get(clave)
+            lider = fut is None
+            if lider:
+                fut = self._en_curso[clave] = Future()
+        if not lider:
+            return fut.result()
+        try:
+            valor = fn()
+            if cachear is None or cachear(valor):
+                self.guardar(clave, valor)
+            fut.set_result(valor)
+            return valor
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._en_curso.pop(clave, None)
+
+    def limpiar(self):
+        with self._lock:
+            self._datos.clear()
+
+    def estadisticas(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'items': len(self._datos)}
+
+
+def cacheado(cache, clave, cachear=None):
+    """
+    Decorador: memoiza la función en `cache` usando `clave(*args, **kwargs)`
+    como clave lógica (se combina con el nombre de la función).
+    """
+    def decorador(fn):
+        @functools.wraps(fn)
+        def envoltura(*args, **kwargs):
+            k = clave_hash(fn.__name__, clave(*args, **kwargs))
+            return cache.llamar(k, lambda: fn(*args, **kwargs), cachear)
+        envoltura.cache = cache
+        return envoltura
+    return decorador
+
+
+def _marcar_uso(ruta):
+    # Solo el atime: el mtime sigue identificando la versión del archivo.
+    # Sobre el descriptor, para no tocar otro archivo publicado en el medio.
+    with open(ruta, 'rb') as f:
+        st = os.fstat(f.fileno())
+        destino = f.fileno() if os.utime in os.supports_fd else ruta
+        os.utime(destino, ns=(time.time_ns(), st.st_mtime_ns))
+
+
+def _borrar(ruta):
+    try:
+        os.remove(ruta)
+    except FileNotFoundError:
+        pass
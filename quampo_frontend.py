@@ -1,4 +1,6 @@
 import os
+import time
+import hashlib
 import tempfile
 import pathlib
 import numpy as np
@@ -6,12 +8,11 @@ import matplotlib.pyplot as plt
 import streamlit as st
 from datetime import datetime, timedelta
 from quampo_backend import (
-    procesar_imagen,
-    generar_informe,
-    generar_informe_llm,
-    geocode_location,
-    download_gee_image
+    clave_reporte,
+    generar_reporte,
+    vista_indice
 )
+from quampo_jobs import ColaLlena, ColaTrabajos
 
 # ────────────────────────────────────────────────────────────────────
 # Configuración del entorno Streamlit
@@ -20,6 +21,31 @@ os.environ["STREAMLIT_GLOBAL_CONFIG_DIR"] = f"{tmp_dir}/.streamlit"
 os.environ["MPLCONFIGDIR"] = f"{tmp_dir}/.matplotlib"
 os.environ["BROWSER_GATHERUSAGESTATS"] = "false"
 
+# ────────────────────────────────────────────────────────────────────
+# Los informes corren en una cola de trabajos compartida por todas las
+# sesiones del servidor: la página solo envía el pedido y consulta su estado
+# en cada rerun. Pedidos idénticos comparten la misma ejecución.
+POLL_SECONDS = float(os.getenv("POLL_SECONDS", 1.0))
+
+ETAPAS_UI = {
+    'en_cola':         "⏳ Informe en cola…",
+    'geocodificando':  "🔍 Geocoding de la localidad…",
+    'descargando':     "⌛️ Descargando imagen con GEE…",
+    'procesando':      "⌛️ Procesando imagen…",
+    'informe_tecnico': "📝 Generando informe técnico…",
+    'llm':             "🤖 Redactando informe agronómico…"
+}
+
+@st.cache_resource
+def cola_trabajos():
+    return ColaTrabajos()
+
+@st.cache_data(show_spinner=False)
+def mapa_ndvi(path):
+    # NDVI solo a la resolución del gráfico, leído de los overviews del COG;
+    # las rutas son por contenido (hash de la subida o id de escena)
+    return vista_indice(path, 'NDVI')
+
 st.set_page_config(page_title="Quampo – Análisis Satelital", layout="centered")
 st.title("🛰️ Quanmpo – Análisis Satelital de Cultivos")
 st.markdown(
@@ -34,6 +60,7 @@ uploaded = st.file_uploader(
 if uploaded and "img_bytes" not in st.session_state:
     st.session_state.img_bytes = uploaded.read()
     st.session_state.img_name = uploaded.name
+    st.session_state.img_hash = hashlib.sha256(st.session_state.img_bytes).hexdigest()
     size_kb = len(st.session_state.img_bytes) / 1024
     st.success(f"Archivo **{st.session_state.img_name}** cargado ({size_kb:.1f} KB)")
     try:
@@ -65,7 +92,7 @@ with col2:
 gen_col, reset_col = st.columns([1, 1])
 if reset_col.button("🔄 Resetear todo", type="secondary"):
     st.session_state.clear()
-    st.experimental_rerun()
+    st.rerun()
 generar = gen_col.button("Generar informe")
 
 # 5) Flujo principal
@@ -78,83 +105,89 @@ if generar:
         st.error("⚠️ Ingresa la localidad o pega un enlace de Google Maps.")
         st.stop()
 
-    # 5.1) Obtener imagen (TIFF local o GEE)
-    if "img_bytes" in st.session_state:
-        tmp_path = pathlib.Path(tmp_dir) / st.session_state.img_name
-        with open(tmp_path, "wb") as f:
-            f.write(st.session_state.img_bytes)
-        st.info("⏳ Procesando imagen TIFF subida…")
-        try:
-            promedios, indices, tipo, meta = procesar_imagen(str(tmp_path))
-            fuente = f"Imagen subida: {st.session_state.img_name}"
-            if not meta.get('crs'):
-                st.warning("La imagen no tiene georreferenciación; el mapa NDVI no incluirá coordenadas reales.")
-        except Exception as e:
-            st.error(f"Error procesando la imagen subida: {e}")
-            st.stop()
-    else:
-        # Extraer coordenadas de Google Maps URL o geocoding de texto
-        if maps_link:
-            import re
-            m = re.search(r'@(-?\d+\.\d+),(-?\d+\.\d+)', maps_link)
-            if not m:
-                st.error("URL de Google Maps inválida: no encontré '@lat,lon'.")
-                st.stop()
-            lat, lon = float(m.group(1)), float(m.group(2))
-        else:
-            st.info("🔍 Geocoding de la localidad…")
-            try:
-                lat, lon = geocode_location(ubicacion)
-            except Exception as e:
-                st.error(f"Error geocodificando '{ubicacion}': {e}")
-                st.stop()
-
-        # Descargar y apilar GEE
-        fecha_str = fecha.strftime("%Y-%m-%d")
-        st.info("⌛️ Descargando imagen con GEE…")
-        ruta_local, meta_gee = download_gee_image(lat, lon, fecha_str, window_days=window, max_cloud_pct=cloud)
-        if not ruta_local:
-            st.error("No se encontró imagen Sentinel-2 …")
-            st.stop()
-        st.write(f"{meta_gee['notice']} (fecha real: {meta_gee['actual_date']})")
-        st.success(f"Imagen descargada: {pathlib.Path(ruta_local).name} (Fecha real: {meta_gee['actual_date']}, Nubosidad {meta_gee['cloud_pct']}%)")
-        st.info("⌛️ Procesando imagen descargada…")
-        try:
-            promedios, indices, tipo, meta = procesar_imagen(ruta_local)
-            fuente = f"GEE Sentinel-2: {meta_gee['actual_date']}"
-        except Exception as e:
-            st.error(f"Error procesando la imagen descargada: {e}")
+    # Coordenadas del enlace de Google Maps (si no, se geocodifica en el trabajo)
+    lat = lon = None
+    if maps_link:
+        import re
+        m = re.search(r'@(-?\d+\.\d+),(-?\d+\.\d+)', maps_link)
+        if not m:
+            st.error("URL de Google Maps inválida: no encontré '@lat,lon'.")
             st.stop()
+        lat, lon = float(m.group(1)), float(m.group(2))
+
+    # 5.1) Imagen: TIFF subido o descarga de GEE dentro del trabajo
+    ruta_img = fuente = img_hash = None
+    if "img_bytes" in st.session_state:
+        # El archivo se nombra por contenido: solo se escribe la primera vez
+        tmp_path = pathlib.Path(tmp_dir) / f"quampo_{st.session_state.img_hash}.tif"
+        if not tmp_path.exists():
+            with open(tmp_path, "wb") as f:
+                f.write(st.session_state.img_bytes)
+        ruta_img, img_hash = str(tmp_path), st.session_state.img_hash
+        fuente = f"Imagen subida: {st.session_state.img_name}"
 
-    # 5.2) Generar informe técnico
-    st.info("📝 Generando informe técnico…")
+    fecha_str, siembra_str = fecha.strftime("%Y-%m-%d"), fecha_siembra.strftime("%Y-%m-%d")
+    clave = clave_reporte(fecha_str, cultivo, ubicacion, siembra_str, lat, lon, img_hash,
+                          window, cloud)
     try:
-        informe_tecnico = generar_informe(promedios, fecha.strftime("%Y-%m-%d"), cultivo, ubicacion, tipo, fecha_siembra.strftime("%Y-%m-%d"), fuente)
-    except Exception as e:
-        st.error(f"Error generando informe: {e}")
+        st.session_state.trabajo = cola_trabajos().enviar(
+            clave, generar_reporte, fecha_str, cultivo, ubicacion, siembra_str,
+            lat=lat, lon=lon, path=ruta_img, fuente=fuente,
+            window_days=window, max_cloud_pct=cloud, imagen=img_hash
+        )
+    except ColaLlena as e:
+        st.error(str(e))
         st.stop()
-    st.subheader("✅ Informe técnico completo")
-    st.markdown(f"```\n{informe_tecnico}\n```")
-
-    # 5.3) Informe agronómico LLM
-    st.subheader("🤖 Informe agronómico profesional")
-    with st.spinner("Llamando a la LLM..."):
-        try:
-            informe_llm = generar_informe_llm(informe_tecnico)
-            st.markdown(informe_llm)
-        except Exception as e:
-            st.error(f"Error al generar informe LLM: {e}")
-
-    # 5.4) Mapa NDVI
-    if "NDVI" in indices:
-        arr_ndvi = indices["NDVI"]
-    elif "NDVI_orientativo" in indices:
-        arr_ndvi = indices["NDVI_orientativo"]
-    else:
+
+# 5.2) Estado del trabajo: se muestra lo que ya está listo y se vuelve a
+#      consultar hasta que termine
+if "trabajo" in st.session_state:
+    trabajo = cola_trabajos().estado(st.session_state.trabajo)
+    if trabajo is None:
+        del st.session_state["trabajo"]
+        st.warning("El informe ya no está disponible; generalo de nuevo.")
+        st.stop()
+    datos = trabajo['resultado'] or trabajo['datos']
+    if trabajo['estado'] == 'error':
+        st.error(f"Error generando el informe: {trabajo['error']}")
+        st.stop()
+
+    meta_gee, meta = datos.get('meta_gee'), datos.get('meta') or {}
+    if meta_gee:
+        st.success(f"Imagen: {meta_gee['notice']} (Fecha real: {meta_gee['actual_date']}, Nubosidad {meta_gee['cloud_pct']}%)")
+    if meta and not meta.get('crs'):
+        st.warning("La imagen no tiene georreferenciación; el mapa NDVI no incluirá coordenadas reales.")
+
+    if datos.get('texto_tecnico'):
+        st.subheader("✅ Informe técnico completo")
+        st.markdown(f"```\n{datos['texto_tecnico']}\n```")
+
+    if datos.get('informe'):
+        st.subheader("🤖 Informe agronómico profesional")
+        st.markdown(datos['informe'])
+
+    if trabajo['estado'] != 'listo':
+        st.info(ETAPAS_UI.get(trabajo['estado'], "⏳ Procesando…") + f" ({trabajo['segundos']:.0f}s)")
+        time.sleep(POLL_SECONDS)
+        st.rerun()
+
+    metricas = datos.get('metricas_llm') or {}
+    if metricas:
+        st.caption(
+            f"Primer token: {metricas['ttft'] or 0:.2f}s · total: {metricas['latencia']:.2f}s"
+            + (f" · tokens {metricas['tokens_prompt']}+{metricas['tokens_completion']}"
+               if metricas.get('tokens_prompt') is not None else " · desde caché")
+        )
+
+    # 5.3) Mapa NDVI
+    try:
+        arr_ndvi, _ = mapa_ndvi(datos['ruta'])
+    except OSError as e:
+        # incluye RasterioIOError: escena ya podada de la caché, archivo
+        # temporal borrado o COG ilegible; lo demás es un error real
         arr_ndvi = None
-    if arr_ndvi is None:
-        st.warning("No se encontró índice NDVI para visualizar.")
-    else:
+        st.warning(f"No se pudo leer la escena para el mapa NDVI: {e}")
+    if arr_ndvi is not None:
         fig, ax = plt.subplots()
         extent = None
         if meta.get("bounds"):
@@ -167,9 +200,9 @@ if generar:
         st.subheader("🗺️ Mapa NDVI")
         st.pyplot(fig)
 
-    # 5.5) Estadísticas de índices promedio
+    # 5.4) Estadísticas de índices promedio
     st.subheader("📊 Estadísticas de índices promedio")
     stats_md = "| Índice | Promedio |\n|---|---:|\n"
-    for k, v in promedios.items():
+    for k, v in datos['promedios'].items():
         stats_md += f"| {k} | {v:.3f} |\n"
     st.markdown(stats_md)
@@ -0,0 +1,977 @@
+import os
+import tempfile
+import threading
+import weakref
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+from itertools import repeat
+import numpy as np
+import rasterio
+from rasterio.enums import MaskFlags, Resampling
+from rasterio.features import rasterize
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_geom
+from rasterio.windows import Window
+
+# === Índices de vegetación ===
+# Orden fijo de bandas en los GeoTIFF de Quampo: [B4, B3, B2, B8, B8A, B11]
+BANDAS  = ('B4', 'B3', 'B2', 'B8', 'B8A', 'B11')
+INDICES = ('NDVI', 'EVI', 'NDMI', 'NDWI', 'SAVI', 'GNDVI', 'NDRE', 'MSAVI')
+EPS = 1e-5  # evita división por cero
+NODATA = 0  # nodata de las bandas UInt16 descargadas (convención de Sentinel-2 L2A)
+
+# Procesamiento por ventanas (via env vars)
+BLOCK_PIXELS  = int(os.getenv("BLOCK_PIXELS",  1 << 20))     # píxeles por ventana
+STREAM_PIXELS = int(os.getenv("STREAM_PIXELS", 25_000_000))  # umbral para modo streaming
+STRIP_PIXELS  = int(os.getenv("STRIP_PIXELS",  1 << 18))     # píxeles por franja en memoria
+PREVIEW_SIDE  = int(os.getenv("PREVIEW_SIDE",  800))         # lado máximo de la vista previa
+WORKERS       = int(os.getenv("WORKERS", os.cpu_count() or 1))  # workers en modo streaming
+POOL          = os.getenv("POOL", "thread")                      # 'thread' o 'process'
+
+# Arrays por píxel bajo demanda (via env vars)
+INDICES_MEMMAP  = os.getenv("INDICES_MEMMAP", "0") == "1"  # en archivos mapeados en lugar del heap
+INDICES_SCRATCH = os.getenv("INDICES_SCRATCH") or None     # directorio de esos archivos (temporal del sistema)
+
+# Detección de cambios entre fechas (via env vars)
+CHANGE_THRESHOLD = float(os.getenv("CHANGE_THRESHOLD", 0.1))  # caída significativa (unidades del índice)
+DELTA_ESCALA = 1e-4        # raster de diferencias: valor = entero × DELTA_ESCALA
+DELTA_NODATA = -32768
+
+# Las mismas fórmulas que calcula _kernel, como expresiones para
+# ee.Image.expression (modo de promedios en el servidor de Earth Engine)
+EXPRESIONES = {
+    'NDVI':  '(N - R) / (N + R + 1e-5)',
+    'EVI':   '2.5 * (N - R) / (N + 6*R - 7.5*B + 1e-5)',
+    'NDMI':  '(N - S) / (N + S + 1e-5)',
+    'NDWI':  '(G - N) / (G + N + 1e-5)',
+    'SAVI':  '1.5 * (N - R) / (N + R + 0.5 + 1e-5)',
+    'GNDVI': '(G - R) / (G + R + 1e-5)',
+    'NDRE':  '(RE - R) / (RE + R + 1e-5)',
+    'MSAVI': '(2*N + 1 - sqrt((2*N + 1)**2 - 8*(N - R))) / 2'
+}
+
+# Índices que usan las subexpresiones compartidas N−R y N+R
+_USAN_DIF  = {'NDVI', 'EVI', 'SAVI', 'MSAVI'}
+_USAN_SUMA = {'NDVI', 'SAVI'}
+
+
+def seleccionar_indices(indices=None):
+    """Valida `indices` y los devuelve en el orden canónico de INDICES."""
+    if indices is None:
+        return INDICES
+    pedidos = {str(i).upper() for i in indices}
+    desconocidos = sorted(pedidos - set(INDICES))
+    if desconocidos:
+        raise ValueError(f"Índices desconocidos: {', '.join(desconocidos)}")
+    return tuple(k for k in INDICES if k in pedidos)
+
+
+# === Lectura de bandas ===
+def leer_bandas(src, window=None, out=None):
+    """
+    Lee las 6 primeras bandas de `src` como float32 con NaN donde no hay dato.
+    `out` puede ser un buffer (6, filas, cols) float32 para reutilizar memoria.
+    """
+    if src.count < 6:
+        raise ValueError(f"Esperaba 6 bandas (B4,B3,B2,B8,B8A,B11), encontré {src.count}")
+    if window is not None:
+        shape = (6, int(window.height), int(window.width))
+    else:
+        shape = (6, src.height, src.width)
+    if out is None:
+        out = np.empty(shape, dtype=np.float32)
+    for i in range(6):
+        src.read(i + 1, window=window, out=out[i])
+        if MaskFlags.all_valid not in src.mask_flag_enums[i]:
+            out[i][src.read_masks(i + 1, window=window) == 0] = np.nan
+    return out
+
+
+class BandasCrudas:
+    """
+    Las 6 bandas en su tipo nativo (uint16 en las escenas de GEE), sin pasar
+    a float: ocupan la mitad que float32. `reflectancia` convierte una franja
+    de filas a float32 con NaN donde no hay dato, justo antes del kernel.
+    El nodata se resuelve por valor o, si el dataset usa una máscara, con un
+    bool por píxel (compartido entre bandas si la máscara es por dataset).
+    """
+
+    def __init__(self, datos, nodata, mascaras):
+        self.datos = datos          # (6, filas, cols) tipo nativo
+        self.nodata = nodata        # por banda: valor nodata o None
+        self.mascaras = mascaras    # por banda: bool (True = sin dato) o None
+
+    @classmethod
+    def leer(cls, src, window=None, out_shape=None, resampling=Resampling.nearest):
+        """
+        Con `out_shape` (filas, cols) la lectura se remuestrea; GDAL usa el
+        overview más cercano, así que el costo depende del tamaño pedido.
+        """
+        if src.count < 6:
+            raise ValueError(f"Esperaba 6 bandas (B4,B3,B2,B8,B8A,B11), encontré {src.count}")
+        lectura = dict(window=window)
+        if out_shape is not None:
+            lectura.update(out_shape=tuple(out_shape), resampling=resampling)
+        datos = src.read(list(range(1, 7)), **lectura)
+        nodata, mascaras, compartida = [None] * 6, [None] * 6, None
+        for i in range(6):
+            flags = src.mask_flag_enums[i]
+            if MaskFlags.all_valid in flags:
+                continue
+            if MaskFlags.nodata in flags:
+                # un nodata NaN ya queda como NaN al convertir
+                if not np.isnan(src.nodatavals[i]):
+                    nodata[i] = datos.dtype.type(src.nodatavals[i])
+            elif MaskFlags.per_dataset in flags:
+                if compartida is None:
+                    compartida = src.read_masks(i + 1, **lectura) == 0
+                mascaras[i] = compartida
+            else:
+                mascaras[i] = src.read_masks(i + 1, **lectura) == 0
+        return cls(datos, nodata, mascaras)
+
+    @property
+    def shape(self):
+        return self.datos.shape[1:]
+
+    def _invalidos(self, i, filas=slice(None)):
+        if self.nodata[i] is not None:
+            return self.datos[i, filas] == self.nodata[i]
+        if self.mascaras[i] is not None:
+            return self.mascaras[i][filas]
+        return None
+
+    def maximo(self):
+        """Máximo de las 6 bandas sin contar nodata (NaN si no hay datos)."""
+        maxv = float('nan')
+        for i in range(6):
+            invalidos = self._invalidos(i)
+            validos = True if invalidos is None else ~invalidos
+            if not np.any(validos):
+                continue
+            inicial = -np.inf if self.datos.dtype.kind == 'f' else np.iinfo(self.datos.dtype).min
+            maxv = np.fmax(maxv, float(np.fmax.reduce(self.datos[i], axis=None,
+                                                      where=validos, initial=inicial)))
+        return float(maxv)
+
+    def reflectancia(self, filas, escala=None, out=None):
+        """Franja `filas` (slice) como float32 /escala con NaN = sin dato."""
+        datos = self.datos[:, filas]
+        if out is None:
+            out = np.empty(datos.shape, dtype=np.float32)
+        for i in range(6):
+            np.copyto(out[i], datos[i], casting='unsafe')
+            invalidos = self._invalidos(i, filas)
+            if invalidos is not None:
+                out[i][invalidos] = np.nan
+        if escala is not None:
+            out /= escala
+        return out
+
+
+def _dif_normalizada(a, b, out, tmp):
+    # (a − b) / (a + b + EPS) sin temporales adicionales
+    np.subtract(a, b, out=out)
+    np.add(a, b, out=tmp)
+    tmp += EPS
+    np.divide(out, tmp, out=out)
+    return out
+
+
+# === Kernel fusionado ===
+def _kernel(bandas, sel, buf):
+    # Genera (índice, array) a medida que se calcula cada uno, para que el
+    # llamador pueda reducirlo y reutilizar el buffer antes del siguiente.
+    R, G, B, N, RE, S = bandas
+    tmp = np.empty(R.shape, dtype=np.float32)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dif = np.subtract(N, R) if _USAN_DIF.intersection(sel) else None
+        suma = np.add(N, R) if _USAN_SUMA.intersection(sel) else None
+
+        if 'NDVI' in sel:
+            np.add(suma, EPS, out=tmp)
+            yield 'NDVI', np.divide(dif, tmp, out=buf('NDVI'))
+        if 'EVI' in sel:
+            o = buf('EVI')
+            np.multiply(R, 6, out=tmp)
+            tmp += N
+            np.multiply(B, 7.5, out=o)
+            tmp -= o
+            tmp += EPS
+            np.divide(dif, tmp, out=o)
+            o *= 2.5
+            # el denominador de EVI puede anularse: se trata como sin dato
+            o[np.isinf(o)] = np.nan
+            yield 'EVI', o
+        if 'NDMI' in sel:
+            yield 'NDMI', _dif_normalizada(N, S, buf('NDMI'), tmp)    # humedad biomasa
+        if 'NDWI' in sel:
+            yield 'NDWI', _dif_normalizada(G, N, buf('NDWI'), tmp)    # verde–NIR
+        if 'SAVI' in sel:
+            o = buf('SAVI')
+            np.add(suma, 0.5 + EPS, out=tmp)
+            np.divide(dif, tmp, out=o)
+            o *= 1.5
+            yield 'SAVI', o
+        if 'GNDVI' in sel:
+            yield 'GNDVI', _dif_normalizada(G, R, buf('GNDVI'), tmp)
+        if 'NDRE' in sel:
+            yield 'NDRE', _dif_normalizada(RE, R, buf('NDRE'), tmp)   # clorofila vía red-edge
+        if 'MSAVI' in sel:
+            # (2N + 1 − sqrt((2N + 1)² − 8(N − R))) / 2 ; MSAVI es el último,
+            # así que se puede pisar `dif`
+            o = buf('MSAVI')
+            np.multiply(N, 2, out=tmp)
+            tmp += 1
+            np.square(tmp, out=o)
+            dif *= 8
+            o -= dif
+            np.sqrt(o, out=o)
+            np.subtract(tmp, o, out=o)
+            o *= 0.5
+            yield 'MSAVI', o
+
+
+def calcular_indices(bandas, indices=None, out=None):
+    """
+    Calcula en una sola pasada los índices pedidos a partir de las bandas
+    float32 [R, G, B, N, RE, S] (NaN = sin dato).
+
+    Reutiliza las subexpresiones N−R y N+R y escribe cada índice en un buffer
+    preasignado: `out` puede traer buffers por nombre de índice para reusarlos
+    entre llamadas. Devuelve el dict {índice: array float32}.
+    """
+    sel = seleccionar_indices(indices)
+    out = {} if out is None else out
+    shape = bandas[0].shape
+
+    def buf(k):
+        b = out.get(k)
+        if b is None or b.shape != shape:
+            b = out[k] = np.empty(shape, dtype=np.float32)
+        return b
+
+    return dict(_kernel(bandas, sel, buf))
+
+
+def vista_previa(src, indices=('NDVI',), max_lado=None):
+    """
+    Índices calculados sobre una lectura reducida de `src` cuyo lado mayor
+    es a lo sumo `max_lado` (PREVIEW_SIDE). Con overviews en el archivo el
+    costo no depende de la resolución original. Devuelve {índice: array}.
+    """
+    max_lado = max_lado or PREVIEW_SIDE
+    factor = max(1.0, max(src.width, src.height) / max_lado)
+    forma = (max(1, round(src.height / factor)), max(1, round(src.width / factor)))
+    crudas = BandasCrudas.leer(src, out_shape=forma, resampling=Resampling.average)
+    maxv = crudas.maximo()
+    bandas = crudas.reflectancia(slice(None), np.float32(maxv) if maxv > 1 else None)
+    return calcular_indices(bandas, indices)
+
+
+# === Clases por píxel ===
+class Clases:
+    """
+    Categorías de un índice como bordes precalculados. `clasificar` convierte
+    un array (o un chunk) en un raster uint8 con el número de categoría:
+    la categoría i cubre (bordes[i-1], bordes[i]] y los valores fuera de
+    [minimo, maximo] o NaN reciben FUERA_DE_RANGO o SIN_DATO.
+
+    `empate_superior` (un bool por borde) marca los bordes donde el empate
+    va a la categoría superior, [bordes[i-1], bordes[i]): se resuelve con
+    >= en lugar de correr el borde. Los bordes se llevan al tipo del array
+    hacia el lado que conserva la comparación exacta, así un float32 cae en
+    la misma categoría que su valor en float64.
+    """
+    FUERA_DE_RANGO = 254
+    SIN_DATO = 255
+
+    def __init__(self, etiquetas, bordes, minimo=-np.inf, maximo=np.inf, empate_superior=None):
+        if len(bordes) != len(etiquetas) - 1:
+            raise ValueError("Se necesitan len(etiquetas) - 1 bordes")
+        self.etiquetas = list(etiquetas)
+        self.bordes = [float(b) for b in bordes]
+        self.minimo = float(minimo)
+        self.maximo = float(maximo)
+        self.empate_superior = ([False] * len(self.bordes) if empate_superior is None
+                                else [bool(e) for e in empate_superior])
+        if len(self.empate_superior) != len(self.bordes):
+            raise ValueError("empate_superior necesita un valor por borde")
+        self._por_tipo = {}
+
+    def _limites(self, dtype):
+        # (bordes, minimo, maximo) en `dtype`: para `v > b` el mayor valor
+        # representable <= b, para `v >= b` (y `v < minimo`) el menor >= b
+        if dtype not in self._por_tipo:
+            def convertir(b, hacia_arriba):
+                c = dtype.type(b)
+                if hacia_arriba and float(c) < b:
+                    c = np.nextafter(c, dtype.type(np.inf))
+                elif not hacia_arriba and float(c) > b:
+                    c = np.nextafter(c, dtype.type(-np.inf))
+                return c
+            self._por_tipo[dtype] = (
+                [convertir(b, arriba) for b, arriba in zip(self.bordes, self.empate_superior)],
+                convertir(self.minimo, True),
+                convertir(self.maximo, False)
+            )
+        return self._por_tipo[dtype]
+
+    @classmethod
+    def desde_glosario(cls, rangos):
+        """A partir de [{'rango': [a, b], 'significado': ...}, ...] contiguos."""
+        for r0, r1 in zip(rangos, rangos[1:]):
+            if r0['rango'][1] != r1['rango'][0]:
+                raise ValueError(f"Rangos no contiguos: {r0['rango']} / {r1['rango']}")
+        return cls([r['significado'] for r in rangos],
+                   [r['rango'][1] for r in rangos[:-1]],
+                   rangos[0]['rango'][0], rangos[-1]['rango'][1])
+
+    def clasificar(self, arr, out=None):
+        if out is None:
+            out = np.zeros(arr.shape, dtype=np.uint8)
+        else:
+            out.fill(0)
+        # categoría = cantidad de bordes superados por el valor; en un empate
+        # gana la categoría inferior, como en el glosario (salvo empate_superior)
+        mayor = np.empty(arr.shape, dtype=bool)
+        tipo = arr.dtype if arr.dtype.kind == 'f' else np.dtype(np.float64)
+        bordes, minimo, maximo = self._limites(tipo)
+        with np.errstate(invalid='ignore'):
+            for b, arriba in zip(bordes, self.empate_superior):
+                out += (np.greater_equal if arriba else np.greater)(arr, b, out=mayor)
+            if self.minimo > -np.inf:
+                out[np.less(arr, minimo, out=mayor)] = self.FUERA_DE_RANGO
+            if self.maximo < np.inf:
+                out[np.greater(arr, maximo, out=mayor)] = self.FUERA_DE_RANGO
+        out[np.isnan(arr, out=mayor)] = self.SIN_DATO
+        return out
+
+    def categoria(self, valor):
+        """Etiqueta de un valor escalar (misma regla que `clasificar`)."""
+        return self.etiqueta(self.clasificar(np.array([valor], dtype=np.float64))[0])
+
+    def etiqueta(self, codigo):
+        codigo = int(codigo)
+        if codigo == self.SIN_DATO:
+            return 'Sin dato'
+        if codigo == self.FUERA_DE_RANGO:
+            return 'Interpretación no disponible'
+        return self.etiquetas[codigo]
+
+
+class Acumulador:
+    """
+    Sumas, conteos y mín/máx corrientes de cada índice (ignorando NaN) y,
+    si se pasan `clases` ({índice: Clases}), píxeles por categoría.
+    """
+
+    def __init__(self, indices=None, clases=None):
+        self.indices = seleccionar_indices(indices)
+        self.suma = dict.fromkeys(self.indices, 0.0)
+        self.n    = dict.fromkeys(self.indices, 0)
+        self.min  = dict.fromkeys(self.indices, float('inf'))
+        self.max  = dict.fromkeys(self.indices, float('-inf'))
+        self.clases = {k: c for k, c in (clases or {}).items() if k in self.indices}
+        self.conteos = {k: np.zeros(256, dtype=np.int64) for k in self.clases}
+
+    def agregar(self, k, arr, codigos=None):
+        if k in self.clases:
+            codigos = self.clases[k].clasificar(arr, codigos)
+            self.conteos[k] += np.bincount(codigos.ravel(), minlength=256)
+        validos = ~np.isnan(arr)
+        n = int(np.count_nonzero(validos))
+        if n == 0:
+            return codigos
+        self.suma[k] += float(np.sum(arr, where=validos, dtype=np.float64))
+        self.n[k]    += n
+        self.min[k] = min(self.min[k], float(np.min(arr, where=validos, initial=np.inf)))
+        self.max[k] = max(self.max[k], float(np.max(arr, where=validos, initial=-np.inf)))
+        return codigos
+
+    def fusionar(self, otro):
+        for k in self.indices:
+            self.suma[k] += otro.suma[k]
+            self.n[k]    += otro.n[k]
+            self.min[k] = min(self.min[k], otro.min[k])
+            self.max[k] = max(self.max[k], otro.max[k])
+        for k in self.conteos:
+            self.conteos[k] += otro.conteos[k]
+        return self
+
+    def fracciones(self):
+        """{índice: {categoría: {'pixeles', 'fraccion'}}} sobre los píxeles con dato."""
+        res = {}
+        for k, conteo in self.conteos.items():
+            total = int(conteo[:Clases.SIN_DATO].sum())
+            res[k] = {
+                self.clases[k].etiqueta(c): {'pixeles': int(conteo[c]),
+                                             'fraccion': int(conteo[c]) / total if total else float('nan')}
+                for c in np.flatnonzero(conteo[:Clases.SIN_DATO])
+            }
+        return res
+
+    def promedios(self):
+        return {k: self.suma[k] / self.n[k] if self.n[k] else float('nan')
+                for k in self.indices}
+
+    def estadisticas(self):
+        return {k: {'n': self.n[k],
+                    'min': self.min[k] if self.n[k] else float('nan'),
+                    'max': self.max[k] if self.n[k] else float('nan')}
+                for k in self.indices}
+
+
+def promedios_indices(bandas, indices=None, arrays=False, acum=None, clases=None, destino=None):
+    """
+    Promedio (ignorando NaN) de cada índice en una sola pasada del kernel.
+    Con `arrays=False` todos los índices se reducen sobre un único buffer
+    reutilizado; con `arrays=True` (o un iterable de nombres) se devuelven
+    además esos arrays completos. Si se pasa `acum`, los valores se suman a
+    ese Acumulador (y los promedios devueltos son los acumulados).
+
+    Con `clases` ({índice: Clases}) también se cuentan los píxeles por
+    categoría, y para los índices de `arrays` se agrega en `funcs` su raster
+    de categorías uint8 bajo la clave '<índice>_clases'. `destino` puede
+    traer esos arrays ya asignados (p. ej. vistas de una franja).
+    """
+    destino = destino or {}
+    sel = seleccionar_indices(indices)
+    conservar = _conservados(sel, arrays)
+    acum = Acumulador(sel, clases) if acum is None else acum
+
+    shape = bandas[0].shape
+    scratch, codigos = [], None
+
+    def buf(k):
+        if k in conservar:
+            return destino[k] if k in destino else np.empty(shape, dtype=np.float32)
+        if not scratch:
+            scratch.append(np.empty(shape, dtype=np.float32))
+        return scratch[0]
+
+    funcs = {}
+    for k, arr in _kernel(bandas, sel, buf):
+        if k in conservar:
+            funcs[k] = arr
+            if k in acum.clases:
+                funcs[f'{k}_clases'] = acum.agregar(k, arr, destino.get(f'{k}_clases'))
+                continue
+        codigos = acum.agregar(k, arr, codigos)
+    return acum.promedios(), funcs
+
+
+def promedios_por_franjas(crudas, indices=None, arrays=False, acum=None, clases=None,
+                          escala=None, max_pixeles=None):
+    """
+    Como `promedios_indices`, pero a partir de BandasCrudas: recorre la
+    imagen por franjas de filas (~max_pixeles), pasa cada franja a
+    reflectancia float32 (/escala) en un buffer reutilizado y escribe los
+    arrays pedidos directamente en su lugar dentro de los de imagen completa.
+    Si las bandas ya son float32 se convierten en el lugar (se modifican).
+    """
+    sel = seleccionar_indices(indices)
+    conservar = _conservados(sel, arrays)
+    acum = Acumulador(sel, clases) if acum is None else acum
+
+    alto, ancho = crudas.shape
+    funcs = {k: np.empty((alto, ancho), dtype=np.float32) for k in conservar}
+    funcs.update({f'{k}_clases': np.empty((alto, ancho), dtype=np.uint8)
+                  for k in funcs if k in acum.clases})
+    en_sitio = crudas.datos.dtype == np.float32
+    for filas, buffer in _franjas(alto, ancho, max_pixeles, buffer=not en_sitio):
+        out = crudas.datos[:, filas] if en_sitio else buffer
+        bandas = crudas.reflectancia(filas, escala, out=out)
+        promedios_indices(bandas, sel, arrays=conservar, acum=acum,
+                          destino={k: v[filas] for k, v in funcs.items()})
+    return acum.promedios(), funcs
+
+
+# === Arrays por píxel bajo demanda ===
+class IndicesPerezosos(Mapping):
+    """
+    Arrays por píxel de `path` (los de `arrays` dentro de `indices`, más
+    '<índice>_clases' si hay `clases`) calculados recién al pedirlos: cada
+    acceso relee el archivo por franjas y corre el kernel solo para ese
+    índice, con la misma `escala` que la pasada de promedios, así que los
+    valores son idénticos a los de calcular todo de una vez.
+
+    Los arrays se guardan con referencias débiles: mientras el llamador
+    conserve uno, pedirlo de nuevo no lo recalcula, y al soltarlo se libera.
+    Con `memmap=True` (por defecto INDICES_MEMMAP) viven en archivos
+    temporales mapeados en memoria en lugar del heap.
+
+    Vida útil: si hay arrays para pedir, el dataset queda abierto mientras
+    viva el objeto (o hasta `cerrar()`). Si la escena se borra o se
+    reemplaza por otro archivo (como hace CacheEscenas al podar o guardar),
+    se sigue leyendo la original, así que toda clave que `in` reporta se
+    puede pedir; un hit de CacheEscenas solo cambia el atime y tampoco
+    afecta. Si el mismo archivo se reescribe en el lugar (cambia su mtime o
+    tamaño), los valores ya no corresponderían a los promedios calculados:
+    el acceso falla con RuntimeError en lugar de devolver otros datos.
+    """
+
+    def __init__(self, path, indices=None, arrays=True, clases=None, escala=None,
+                 memmap=None, max_pixeles=None):
+        pedidos = _conservados(seleccionar_indices(indices), arrays)
+        self.path = path
+        self.escala = escala
+        self.memmap = INDICES_MEMMAP if memmap is None else memmap
+        self.max_pixeles = max_pixeles
+        self.clases = {k: c for k, c in (clases or {}).items() if k in pedidos}
+        self._claves = pedidos + tuple(f'{k}_clases' for k in pedidos if k in self.clases)
+        self._vivos = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()   # un dataset no se lee desde dos hilos a la vez
+        self._src = None
+        if self._claves:
+            self._firma = _firma(path)
+            self._src = rasterio.open(path)
+            self._cierre = weakref.finalize(self, self._src.close)
+
+    def cerrar(self):
+        """Cierra el dataset: solo quedan disponibles los arrays aún en uso."""
+        if self._src is not None:
+            self._cierre()
+
+    def _disponibles(self):
+        # Con el dataset abierto toda clave se puede calcular; cerrado, solo
+        # las que siguen vivas
+        if self._src is not None and self._cierre.alive:
+            return self._claves
+        return tuple(k for k in self._claves if k in self._vivos)
+
+    def __len__(self):
+        return len(self._disponibles())
+
+    def __iter__(self):
+        return iter(self._disponibles())
+
+    def __contains__(self, k):
+        # sin calcular el array (Mapping.__contains__ haría self[k])
+        return k in self._disponibles()
+
+    def __getitem__(self, k):
+        if k not in self._disponibles():
+            raise KeyError(k)
+        arr = self._vivos.get(k)
+        if arr is None:
+            arr = self._vivos[k] = self._calcular(k)
+        return arr
+
+    def _nuevo(self, shape, dtype):
+        if not self.memmap:
+            return np.empty(shape, dtype=dtype)
+        # TemporaryFile se borra al cerrarse: el espacio se libera con el array
+        return np.memmap(tempfile.TemporaryFile(dir=INDICES_SCRATCH), dtype=dtype,
+                         mode='w+', shape=shape)
+
+    def _verificar(self):
+        # Borrado o reemplazado por otro archivo: el handle abierto sigue
+        # leyendo el original. Mismo archivo modificado: ya no coincide.
+        try:
+            firma = _firma(self.path)
+        except FileNotFoundError:
+            return
+        if firma[0] == self._firma[0] and firma != self._firma:
+            raise RuntimeError(f"{self.path} se modificó después de calcular los promedios")
+
+    def _calcular(self, k):
+        if k.endswith('_clases'):
+            arr = self[k[:-len('_clases')]]
+            return self.clases[k[:-len('_clases')]].clasificar(arr, self._nuevo(arr.shape, np.uint8))
+        with self._lock:
+            self._verificar()
+            src = self._src
+            alto, ancho = src.height, src.width
+            out = self._nuevo((alto, ancho), np.float32)
+            for filas, buffer in _franjas(alto, ancho, self.max_pixeles):
+                ventana = Window(0, filas.start, ancho, filas.stop - filas.start)
+                crudas = BandasCrudas.leer(src, window=ventana)
+                bandas = crudas.reflectancia(slice(None), self.escala, out=buffer)
+                destino = out[filas]
+                for _ in _kernel(bandas, (k,), lambda _: destino):
+                    pass
+        return out
+
+
+def _firma(path):
+    # Identifica la versión del archivo: inodo, modificación y tamaño (el
+    # atime no: CacheEscenas lo usa para marcar el uso)
+    st = os.stat(path)
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+# === Detección de cambios (varias fechas, una pasada) ===
+class AcumuladorCambios:
+    """
+    Para cada comparación (fecha de referencia contra una fecha pasada) e
+    índice: Acumulador de la diferencia actual − pasada sobre los píxeles con
+    dato en ambas fechas y píxeles con caída significativa (≤ −umbral).
+    """
+
+    def __init__(self, comparaciones, indices=None, umbral=None):
+        self.indices = seleccionar_indices(indices)
+        umbral = CHANGE_THRESHOLD if umbral is None else umbral
+        self.umbral = (dict(umbral) if isinstance(umbral, dict)
+                       else dict.fromkeys(self.indices, umbral))
+        self.deltas = {c: Acumulador(self.indices) for c in comparaciones}
+        self.caidas = {c: dict.fromkeys(self.indices, 0) for c in comparaciones}
+
+    def agregar(self, c, k, delta):
+        self.deltas[c].agregar(k, delta)
+        with np.errstate(invalid='ignore'):
+            self.caidas[c][k] += int(np.count_nonzero(delta <= -self.umbral[k]))
+
+    def resultados(self):
+        """{comparación: {índice: {'delta_media', 'n', 'min', 'max', 'fraccion_caida'}}}"""
+        res = {}
+        for c, acum in self.deltas.items():
+            medias, stats = acum.promedios(), acum.estadisticas()
+            res[c] = {k: {'delta_media': medias[k], **stats[k],
+                          'fraccion_caida': self.caidas[c][k] / stats[k]['n'] if stats[k]['n'] else float('nan')}
+                      for k in self.indices}
+        return res
+
+
+def alinear(src, ref, resampling=Resampling.nearest):
+    """`src` tal cual si ya está en la grilla de `ref`; si no, un WarpedVRT sobre ella."""
+    if (src.crs, src.transform, src.shape) == (ref.crs, ref.transform, ref.shape):
+        return src
+    return WarpedVRT(src, crs=ref.crs, transform=ref.transform, width=ref.width,
+                     height=ref.height, resampling=resampling)
+
+
+def cambios_por_franjas(paths, indices=None, umbral=None, raster=(), max_pixeles=None):
+    """
+    Diferencias por píxel de cada índice entre la primera escena de `paths`
+    ({nombre: ruta}, la fecha de referencia) y cada una de las demás, en una
+    sola pasada: las franjas de todas las fechas se apilan en un buffer
+    (bandas × fechas × filas × cols) y el kernel calcula cada índice para
+    todas las fechas a la vez. Las escenas que no están en la grilla de la
+    primera se leen remuestreadas sobre ella. Cada fecha se normaliza por
+    su propio máximo, como en procesar_imagen.
+
+    Devuelve (AcumuladorCambios, deltas): `deltas` es None o, si se piden
+    índices en `raster`, un int16 (comparaciones × índices, filas, cols) con
+    la diferencia en unidades de DELTA_ESCALA y DELTA_NODATA sin dato.
+    """
+    sel = seleccionar_indices(indices)
+    raster = _conservados(sel, raster)
+    nombres = list(paths)
+    acum = AcumuladorCambios(nombres[1:], sel, umbral)
+    with ExitStack() as pila:
+        ref = pila.enter_context(rasterio.open(paths[nombres[0]]))
+        srcs = [ref]
+        for n in nombres[1:]:
+            src = pila.enter_context(rasterio.open(paths[n]))
+            alineado = alinear(src, ref)
+            if alineado is not src:
+                pila.enter_context(alineado)
+            srcs.append(alineado)
+        escalas = []
+        for src in srcs:
+            maxv = max_global(src, max_pixeles)
+            escalas.append(np.float32(maxv) if maxv > 1 else None)
+
+        alto, ancho, fechas = ref.height, ref.width, len(srcs)
+        deltas = None
+        if raster:
+            deltas = np.empty(((fechas - 1) * len(raster), alto, ancho), dtype=np.int16)
+        scratch = {}
+        for filas, bandas in _franjas(alto, ancho, max_pixeles, fechas):
+            h = filas.stop - filas.start
+            w = Window(0, filas.start, ancho, h)
+            for d, src in enumerate(srcs):
+                BandasCrudas.leer(src, window=w).reflectancia(slice(None), escalas[d], out=bandas[:, d])
+            delta = _buffer(scratch, (h, ancho))
+            buf = lambda k, shape=bandas[0].shape: _buffer(scratch, shape)
+            for k, arr in _kernel(bandas, sel, buf):
+                for j in range(1, fechas):
+                    np.subtract(arr[0], arr[j], out=delta)
+                    acum.agregar(nombres[j], k, delta)
+                    if k in raster:
+                        _cuantizar_delta(delta, deltas[(j - 1) * len(raster) + raster.index(k), filas])
+    return acum, deltas
+
+
+def _cuantizar_delta(delta, out):
+    # Pisa `delta` (ya acumulado); la saturación deja libre DELTA_NODATA
+    info = np.iinfo(np.int16)
+    np.divide(delta, DELTA_ESCALA, out=delta)
+    np.rint(delta, out=delta)
+    np.clip(delta, info.min + 1, info.max, out=delta)
+    sin_dato = np.isnan(delta)
+    np.copyto(out, delta, casting='unsafe')
+    out[sin_dato] = DELTA_NODATA
+
+
+# === Estadísticas zonales (muchos lotes, una lectura) ===
+def etiquetas_zonas(src, geometrias, crs_geometrias='EPSG:4326'):
+    """
+    Rasteriza `geometrias` (GeoJSON, en `crs_geometrias`) sobre la grilla de
+    `src`: el píxel vale i+1 si su centro cae en la geometría i y 0 fuera de
+    todas. Si dos lotes se superponen, el píxel queda en el último.
+    """
+    if src.crs is not None and str(crs_geometrias) != src.crs.to_string():
+        geometrias = [transform_geom(crs_geometrias, src.crs, g) for g in geometrias]
+    dtype = np.uint16 if len(geometrias) < np.iinfo(np.uint16).max else np.uint32
+    return rasterize(((g, i) for i, g in enumerate(geometrias, 1)),
+                     out_shape=(src.height, src.width), transform=src.transform,
+                     fill=0, dtype=dtype)
+
+
+class AcumuladorZonal:
+    """
+    Sumas, conteos y píxeles por categoría de cada índice, por zona de un
+    raster de etiquetas (0 = fuera de toda zona). Todo se acumula con
+    np.bincount indexado por etiqueta: el costo no depende de la cantidad
+    de zonas.
+    """
+
+    def __init__(self, n_zonas, indices=None, clases=None):
+        self.n_zonas = n_zonas
+        self.indices = seleccionar_indices(indices)
+        m = n_zonas + 1
+        self.pixeles = np.zeros(m, dtype=np.int64)
+        self.suma = {k: np.zeros(m, dtype=np.float64) for k in self.indices}
+        self.n    = {k: np.zeros(m, dtype=np.int64) for k in self.indices}
+        self.clases = {k: c for k, c in (clases or {}).items() if k in self.indices}
+        self.conteos = {k: np.zeros((m, 256), dtype=np.int64) for k in self.clases}
+
+    def agregar_zonas(self, etiquetas):
+        self.pixeles += np.bincount(etiquetas.ravel(), minlength=self.n_zonas + 1)
+
+    def agregar(self, k, arr, etiquetas, codigos=None, base=None):
+        """
+        Suma `arr` por zona. `base` puede traer etiquetas * 256 (intp) ya
+        calculado, para compartirlo entre índices de la misma franja.
+        """
+        m = self.n_zonas + 1
+        e = etiquetas.ravel()
+        validos = ~np.isnan(arr)
+        self.suma[k] += np.bincount(e, weights=np.where(validos, arr, 0).ravel(), minlength=m)
+        if k not in self.clases:
+            self.n[k] += np.bincount(e, weights=validos.ravel(), minlength=m).astype(np.int64)
+            return codigos
+        codigos = self.clases[k].clasificar(arr, codigos)
+        # etiqueta y categoría en un solo índice (zona * 256 + código); los
+        # válidos por zona salen de los mismos conteos (todo código < SIN_DATO)
+        if base is None:
+            base = e.astype(np.intp) * 256
+        conteo = np.bincount(base + codigos.ravel(), minlength=m * 256).reshape(m, 256)
+        self.conteos[k] += conteo
+        self.n[k] += conteo[:, :Clases.SIN_DATO].sum(axis=1)
+        return codigos
+
+    def resultados(self, ids=None):
+        """
+        {id: {'pixeles', 'promedios', 'n', 'clases'}} por zona; `ids` da el
+        id de cada zona en orden (por defecto 1..n_zonas).
+        """
+        ids = list(ids) if ids is not None else list(range(1, self.n_zonas + 1))
+        res = {}
+        for z, zid in enumerate(ids, 1):
+            fila = {
+                'pixeles': int(self.pixeles[z]),
+                'promedios': {k: float(self.suma[k][z] / self.n[k][z]) if self.n[k][z] else float('nan')
+                              for k in self.indices},
+                'n': {k: int(self.n[k][z]) for k in self.indices}
+            }
+            if self.clases:
+                fila['clases'] = {}
+                for k, conteo in self.conteos.items():
+                    c = conteo[z, :Clases.SIN_DATO]
+                    total = int(c.sum())
+                    fila['clases'][k] = {
+                        self.clases[k].etiqueta(i): {'pixeles': int(c[i]),
+                                                     'fraccion': int(c[i]) / total}
+                        for i in np.flatnonzero(c)
+                    }
+            res[zid] = fila
+        return res
+
+
+def acumular_zonas(crudas, etiquetas, n_zonas, indices=None, clases=None, escala=None,
+                   max_pixeles=None):
+    """
+    Estadísticas de todas las zonas en una sola pasada por franjas sobre
+    BandasCrudas (ver `promedios_por_franjas`). Devuelve el AcumuladorZonal.
+    """
+    sel = seleccionar_indices(indices)
+    acum = AcumuladorZonal(n_zonas, sel, clases)
+    alto, ancho = crudas.shape
+    en_sitio = crudas.datos.dtype == np.float32
+    scratch, codigos = {}, None
+    for filas, buffer in _franjas(alto, ancho, max_pixeles, buffer=not en_sitio):
+        out = crudas.datos[:, filas] if en_sitio else buffer
+        bandas = crudas.reflectancia(filas, escala, out=out)
+        # bincount trabaja en intp: convertir la franja una vez, no por índice
+        etq = etiquetas[filas].astype(np.intp)
+        acum.agregar_zonas(etq)
+        base = etq.ravel() * 256 if acum.clases else None
+        # un único buffer de índice por forma de franja
+        buf = lambda k, shape=bandas[0].shape: _buffer(scratch, shape)
+        if codigos is not None and codigos.shape != etq.shape:
+            codigos = None
+        for k, arr in _kernel(bandas, sel, buf):
+            codigos = acum.agregar(k, arr, etq, codigos, base)
+    return acum
+
+
+# === Modo streaming por ventanas ===
+def ventanas(src, max_pixeles=None):
+    """
+    Recorre `src` en ventanas alineadas a sus bloques internos, agrupando
+    bloques hasta `max_pixeles` por ventana (al menos un bloque).
+    """
+    max_pixeles = max_pixeles or BLOCK_PIXELS
+    bh, bw = src.block_shapes[0]
+    bloques_x = max(1, min(-(-src.width // bw), max_pixeles // (bw * bh)))
+    ancho = min(bw * bloques_x, src.width)
+    alto  = min(bh * max(1, max_pixeles // (ancho * bh)), src.height)
+    for fila in range(0, src.height, alto):
+        for col in range(0, src.width, ancho):
+            yield Window(col, fila,
+                         min(ancho, src.width - col),
+                         min(alto, src.height - fila))
+
+
+def _conservados(sel, arrays):
+    # Índices de `sel` cuyos arrays se devuelven: `arrays` es True (todos),
+    # falso (ninguno) o un iterable de nombres
+    if arrays is True:
+        return sel
+    if arrays:
+        return tuple(k for k in sel if k in seleccionar_indices(arrays))
+    return ()
+
+
+def _franjas(alto, ancho, max_pixeles=None, fechas=None, buffer=True):
+    # Franjas de filas de ~max_pixeles (STRIP_PIXELS) píxeles por banda y
+    # fecha: da (slice de filas, vista (6[, fechas], filas, ancho) de un único
+    # buffer float32 reutilizado), o None en lugar de la vista si buffer=False
+    capas = () if fechas is None else (fechas,)
+    paso = max(1, (max_pixeles or STRIP_PIXELS) // max(ancho * (fechas or 1), 1))
+    datos = np.empty((6, *capas, min(paso, alto), ancho), dtype=np.float32) if buffer else None
+    for fila in range(0, alto, paso):
+        filas = slice(fila, min(fila + paso, alto))
+        yield filas, None if datos is None else datos[..., :filas.stop - fila, :]
+
+
+def _buffer(buffers, shape):
+    # Un buffer por forma de ventana (las del borde son más chicas)
+    if shape not in buffers:
+        buffers[shape] = np.empty(shape, dtype=np.float32)
+    return buffers[shape]
+
+
+def _max_estadisticas(src):
+    # Máximo a partir de estadísticas exactas guardadas en el dataset, o None
+    tags = [src.tags(i) for i in range(1, 7)]
+    if all('STATISTICS_MAXIMUM' in t and t.get('STATISTICS_APPROXIMATE', 'NO') != 'YES'
+           for t in tags):
+        return max(float(t['STATISTICS_MAXIMUM']) for t in tags)
+    return None
+
+
+def _max_ventanas(src, lote):
+    maxv, buffers = float('nan'), {}
+    for w in lote:
+        bandas = leer_bandas(src, w, out=_buffer(buffers, (6, int(w.height), int(w.width))))
+        maxv = np.fmax(maxv, np.fmax.reduce(bandas, axis=None))
+    return float(maxv)
+
+
+def max_global(src, max_pixeles=None):
+    """
+    Máximo de las 6 bandas (sin nodata) para la normalización. Usa las
+    estadísticas exactas guardadas en el dataset si existen; si no, hace una
+    pasada barata por ventanas que solo reduce, sin calcular índices.
+    """
+    maxv = _max_estadisticas(src)
+    if maxv is None:
+        maxv = _max_ventanas(src, ventanas(src, max_pixeles))
+    return maxv
+
+
+def _parciales_ventanas(src, lote, sel, escala, clases=None):
+    # Un Acumulador por ventana: fusionarlos en orden de ventana da el mismo
+    # resultado, bit a bit, que el recorrido secuencial
+    parciales, buffers = [], {}
+    for w in lote:
+        bandas = leer_bandas(src, w, out=_buffer(buffers, (6, int(w.height), int(w.width))))
+        if escala is not None:
+            bandas /= escala
+        acum = Acumulador(sel, clases)
+        promedios_indices(bandas, sel, acum=acum)
+        parciales.append(acum)
+    return parciales
+
+
+def acumular_por_ventanas(src, indices=None, max_pixeles=None, maxv=None, clases=None):
+    """
+    Calcula los índices ventana por ventana sobre un dataset abierto y
+    devuelve el Acumulador resultante. La memoria depende solo del tamaño de
+    ventana, no del de la imagen.
+    """
+    sel = seleccionar_indices(indices)
+    if maxv is None:
+        maxv = max_global(src, max_pixeles)
+    escala = np.float32(maxv) if maxv > 1 else None
+
+    acum = Acumulador(sel, clases)
+    for parcial in _parciales_ventanas(src, ventanas(src, max_pixeles), sel, escala, clases):
+        acum.fusionar(parcial)
+    return acum
+
+
+# === Ejecución paralela ===
+def _max_lote(path, lote):
+    with rasterio.open(path) as src:
+        return _max_ventanas(src, lote)
+
+
+def _parciales_lote(path, lote, sel, escala, clases=None):
+    # Cada worker abre su propio handle: los datasets no se comparten entre hilos
+    with rasterio.open(path) as src:
+        return _parciales_ventanas(src, lote, sel, escala, clases)
+
+
+def acumular_en_paralelo(path, indices=None, workers=None, pool=None, max_pixeles=None,
+                         clases=None):
+    """
+    Versión paralela de `acumular_por_ventanas`: reparte lotes contiguos de
+    ventanas entre `workers` hilos o procesos (`pool` = 'thread'|'process') y
+    fusiona los parciales en orden de ventana, así el resultado es idéntico
+    entre corridas e independiente de la cantidad de workers.
+    """
+    sel = seleccionar_indices(indices)
+    workers = workers or WORKERS
+    if workers == 1:
+        with rasterio.open(path) as src:
+            return acumular_por_ventanas(src, sel, max_pixeles, clases=clases)
+    pool = pool or POOL
+    if pool not in ('thread', 'process'):
+        raise ValueError(f"Pool desconocido: {pool} (usar 'thread' o 'process')")
+    executor = ThreadPoolExecutor if pool == 'thread' else ProcessPoolExecutor
+
+    with rasterio.open(path) as src:
+        todas = list(ventanas(src, max_pixeles))
+        maxv = _max_estadisticas(src)
+    # ~4 lotes por worker para balancear ventanas de distinto costo
+    n_lotes = min(len(todas), workers * 4)
+    lotes = [todas[i * len(todas) // n_lotes:(i + 1) * len(todas) // n_lotes]
+             for i in range(n_lotes)]
+
+    acum = Acumulador(sel, clases)
+    with executor(max_workers=workers) as ex:
+        if maxv is None:
+            maxv = float(np.fmax.reduce(list(ex.map(_max_lote, repeat(path), lotes))))
+        escala = np.float32(maxv) if maxv > 1 else None
+        # ex.map devuelve en orden de envío: reducción determinista
+        for parciales in ex.map(_parciales_lote, repeat(path), lotes, repeat(sel),
+                                repeat(escala), repeat(clases)):
+            for parcial in parciales:
+                acum.fusionar(parcial)
+    return acum
@@ -0,0 +1,135 @@
+import os
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# === Cola de trabajos en segundo plano ===
+# Los informes corren en un pool acotado de hilos y se consultan por id. Un
+# pedido idéntico a uno en curso (o terminado hace menos de JOBS_TTL) recibe
+# el mismo id en lugar de repetir el pipeline. La función del trabajo recibe
+# `avance(estado, **datos)` para publicar la etapa y resultados parciales.
+JOBS_WORKERS     = int(os.getenv("JOBS_WORKERS",     4))
+JOBS_TTL         = int(os.getenv("JOBS_TTL",         3600))  # segundos que se guarda un resultado
+JOBS_MAX_PENDING = int(os.getenv("JOBS_MAX_PENDING", 64))    # trabajos en cola o en curso
+
+EN_COLA, LISTO, ERROR = 'en_cola', 'listo', 'error'
+
+
+class ColaLlena(RuntimeError):
+    pass
+
+
+class Trabajo:
+    def __init__(self, id_, clave):
+        self.id = id_
+        self.clave = clave
+        self.estado = EN_COLA
+        self.datos = {}
+        self.resultado = None
+        self.error = None
+        self.creado = time.time()
+        self.terminado = None
+        self._lock = threading.Lock()
+        self._fin = threading.Event()
+
+    def avanzar(self, estado, datos):
+        with self._lock:
+            self.estado = estado
+            self.datos.update(datos)
+
+    def terminar(self, resultado=None, error=None):
+        with self._lock:
+            self.estado = ERROR if error is not None else LISTO
+            self.resultado = resultado
+            self.error = error
+            self.terminado = time.time()
+        self._fin.set()
+
+    @property
+    def activo(self):
+        return self.terminado is None
+
+    def a_dict(self):
+        """Foto del trabajo: estado, datos parciales y resultado (si terminó)."""
+        with self._lock:
+            return {
+                'id': self.id,
+                'estado': self.estado,
+                'datos': dict(self.datos),
+                'resultado': self.resultado,
+                'error': self.error,
+                'creado': self.creado,
+                'terminado': self.terminado,
+                'segundos': round((self.terminado or time.time()) - self.creado, 2)
+            }
+
+
+class ColaTrabajos:
+    """
+    Pool acotado de `workers` hilos con deduplicación por clave: `enviar`
+    devuelve el id de un trabajo igual en curso o terminado hace menos de
+    `ttl` segundos. Los trabajos con error no se reutilizan.
+    """
+
+    def __init__(self, workers=None, ttl=None, max_pendientes=None):
+        self.ttl = JOBS_TTL if ttl is None else ttl
+        self.max_pendientes = max_pendientes or JOBS_MAX_PENDING
+        self._ex = ThreadPoolExecutor(max_workers=workers or JOBS_WORKERS,
+                                      thread_name_prefix='quampo-job')
+        self._trabajos = {}    # id -> Trabajo
+        self._por_clave = {}   # clave -> id
+        self._lock = threading.Lock()
+
+    def _purgar(self):
+        # Llamar con el lock tomado
+        limite = time.time() - self.ttl
+        for id_, t in list(self._trabajos.items()):
+            if not t.activo and t.terminado < limite:
+                del self._trabajos[id_]
+                if self._por_clave.get(t.clave) == id_:
+                    del self._por_clave[t.clave]
+
+    def enviar(self, clave, fn, *args, **kwargs):
+        """Encola `fn(avance, *args, **kwargs)` bajo `clave` y devuelve el id."""
+        with self._lock:
+            self._purgar()
+            previo = self._trabajos.get(self._por_clave.get(clave))
+            if previo is not None and previo.estado != ERROR:
+                return previo.id
+            if sum(t.activo for t in self._trabajos.values()) >= self.max_pendientes:
+                raise ColaLlena("Demasiados informes en curso; reintentá en unos minutos")
+            t = Trabajo(uuid.uuid4().hex, clave)
+            self._trabajos[t.id] = t
+            self._por_clave[clave] = t.id
+        self._ex.submit(self._correr, t, fn, args, kwargs)
+        return t.id
+
+    def _correr(self, t, fn, args, kwargs):
+        def avance(estado, **datos):
+            t.avanzar(estado, datos)
+        try:
+            t.terminar(resultado=fn(avance, *args, **kwargs))
+        except Exception as e:
+            t.terminar(error=f"{type(e).__name__}: {e}")
+
+    def estado(self, id_):
+        """Foto del trabajo (ver Trabajo.a_dict) o None si no existe o venció."""
+        with self._lock:
+            self._purgar()
+            t = self._trabajos.get(id_)
+        return t.a_dict() if t is not None else None
+
+    def esperar(self, id_, timeout=None):
+        """Bloquea hasta que el trabajo termine (o venza `timeout`) y devuelve su estado."""
+        with self._lock:
+            t = self._trabajos.get(id_)
+        if t is None:
+            return None
+        t._fin.wait(timeout)
+        return t.a_dict()
+
+    def estadisticas(self):
+        with self._lock:
+            estados = [t.estado for t in self._trabajos.values()]
+        return {e: estados.count(e) for e in set(estados)}
@@ -0,0 +1,184 @@
+import os
+import json
+import time
+import logging
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager, nullcontext
+
+# === Instrumentación por etapa (spans y contadores) ===
+# Una Traza agrupa los spans y contadores de un informe. Se activa con
+# `traza()` y viaja en un contextvar: las funciones del backend solo llaman a
+# `span()` / `contar()`, que no hacen nada si no hay una traza activa o si
+# TRAZAS=0. Para que los hilos de un executor sumen a la misma traza hay que
+# enviar las tareas con `en_hilo`.
+TRAZAS     = os.getenv("TRAZAS", "1") == "1"
+TRAZAS_LOG = os.getenv("TRAZAS_LOG", "0") == "1"   # una línea JSON por traza en el logger
+
+log = logging.getLogger("quampo.traza")
+
+_actual = contextvars.ContextVar("quampo_traza", default=None)
+_NULO = nullcontext()
+
+
+def _clave(nombre, etiquetas):
+    return (nombre, tuple(sorted(etiquetas.items())))
+
+
+def _texto_clave(clave):
+    # Formato Prometheus: nombre{k="v",...}
+    nombre, etiquetas = clave
+    if not etiquetas:
+        return nombre
+    return nombre + "{" + ",".join(f'{k}="{v}"' for k, v in etiquetas) + "}"
+
+
+class Traza:
+    """Spans (nombre, inicio relativo, duración) y contadores de un informe."""
+
+    def __init__(self, nombre):
+        self.nombre = nombre
+        self.t0 = time.perf_counter()
+        self.spans = []
+        self.contadores = {}
+        self._lock = threading.Lock()
+
+    def agregar_span(self, nombre, inicio, duracion, atributos):
+        with self._lock:
+            self.spans.append({'nombre': nombre, 'inicio': round(inicio - self.t0, 6),
+                               'duracion': round(duracion, 6), **atributos})
+
+    def contar(self, clave, n):
+        with self._lock:
+            self.contadores[clave] = self.contadores.get(clave, 0) + n
+
+    def a_dict(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s['inicio'])
+            contadores = {_texto_clave(k): v for k, v in sorted(self.contadores.items())}
+        return {'nombre': self.nombre, 'total': round(time.perf_counter() - self.t0, 6),
+                'spans': spans, 'contadores': contadores}
+
+    def a_json(self):
+        return json.dumps(self.a_dict(), ensure_ascii=False)
+
+
+# === Agregado global (para el volcado estilo Prometheus) ===
+class _Registro:
+    def __init__(self):
+        self.duraciones = {}   # span -> [suma, cantidad]
+        self.contadores = {}
+        self._lock = threading.Lock()
+
+    def sumar(self, traza):
+        with traza._lock:
+            spans = list(traza.spans)
+            contadores = dict(traza.contadores)
+        with self._lock:
+            for s in spans:
+                d = self.duraciones.setdefault(s['nombre'], [0.0, 0])
+                d[0] += s['duracion']
+                d[1] += 1
+            for k, v in contadores.items():
+                self.contadores[k] = self.contadores.get(k, 0) + v
+
+    def prometheus(self):
+        lineas = ["# TYPE quampo_etapa_segundos summary"]
+        with self._lock:
+            for nombre, (suma, cantidad) in sorted(self.duraciones.items()):
+                lineas.append(f'quampo_etapa_segundos_sum{{etapa="{nombre}"}} {suma:.6f}')
+                lineas.append(f'quampo_etapa_segundos_count{{etapa="{nombre}"}} {cantidad}')
+            nombres = sorted({k[0] for k in self.contadores})
+            for nombre in nombres:
+                lineas.append(f"# TYPE quampo_{nombre}_total counter")
+                for k, v in sorted(self.contadores.items()):
+                    if k[0] == nombre:
+                        lineas.append(f"quampo_{_texto_clave((nombre + '_total', k[1]))} {v}")
+        return "\n".join(lineas) + "\n"
+
+    def limpiar(self):
+        with self._lock:
+            self.duraciones.clear()
+            self.contadores.clear()
+
+
+REGISTRO = _Registro()
+
+
+def prometheus():
+    """Volcado de texto (formato de exposición de Prometheus) de todas las trazas cerradas."""
+    return REGISTRO.prometheus()
+
+
+# === API de instrumentación ===
+@contextmanager
+def traza(nombre):
+    """
+    Activa una Traza para el bloque y la devuelve (None si TRAZAS=0). Si ya
+    hay una activa, se reutiliza: las etapas anidadas suman a la exterior.
+    """
+    if not TRAZAS:
+        yield None
+        return
+    actual = _actual.get()
+    if actual is not None:
+        yield actual
+        return
+    t = Traza(nombre)
+    token = _actual.set(t)
+    try:
+        yield t
+    finally:
+        _actual.reset(token)
+        REGISTRO.sumar(t)
+        if TRAZAS_LOG:
+            log.info(t.a_json())
+
+
+class _Span:
+    __slots__ = ('traza', 'nombre', 'atributos', 't0')
+
+    def __init__(self, traza, nombre, atributos):
+        self.traza, self.nombre, self.atributos = traza, nombre, atributos
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, tipo, valor, tb):
+        if tipo is not None:
+            self.atributos['error'] = tipo.__name__
+        self.traza.agregar_span(self.nombre, self.t0, time.perf_counter() - self.t0, self.atributos)
+        return False
+
+
+def span(nombre, **atributos):
+    """Context manager que mide una etapa dentro de la traza activa."""
+    t = _actual.get()
+    if t is None:
+        return _NULO
+    return _Span(t, nombre, atributos)
+
+
+def contar(nombre, n=1, **etiquetas):
+    """Suma `n` al contador `nombre` (con etiquetas) de la traza activa."""
+    t = _actual.get()
+    if t is not None and n:
+        t.contar(_clave(nombre, etiquetas), n)
+
+
+def etapa(nombre):
+    """Decorador: cada llamada a la función es un span `nombre`."""
+    def decorador(fn):
+        @functools.wraps(fn)
+        def envoltura(*args, **kwargs):
+            with span(nombre):
+                return fn(*args, **kwargs)
+        return envoltura
+    return decorador
+
+
+def en_hilo(ex, fn, *args, **kwargs):
+    """ex.submit que conserva la traza activa en el hilo del executor."""
+    return ex.submit(contextvars.copy_context().run, fn, *args, **kwargs)
@@ -0,0 +1,38 @@
+import os
+
+import quampo_cache
+from quampo_cache import CacheEscenas
+
+
+def _escribir(tam):
+    def escribir(tmp):
+        with open(tmp, 'wb') as f:
+            f.write(b'x' * tam)
+    return escribir
+
+
+def test_guardar_no_poda_lo_que_acaba_de_publicar(tmp_path, monkeypatch):
+    monkeypatch.setattr(quampo_cache, 'CACHE_GRACIA', 0)
+    cache = CacheEscenas(str(tmp_path), max_bytes=1000)
+    ruta = cache.guardar('grande', _escribir(5000))
+    assert os.path.exists(ruta)
+    assert cache.obtener('grande') == ruta
+
+
+def test_poda_lru_fuera_de_la_gracia(tmp_path, monkeypatch):
+    monkeypatch.setattr(quampo_cache, 'CACHE_GRACIA', 0)
+    cache = CacheEscenas(str(tmp_path), max_bytes=1500)
+    vieja = cache.guardar('vieja', _escribir(1000))
+    os.utime(vieja, (1, 1))
+    nueva = cache.guardar('nueva', _escribir(1000))
+    assert not os.path.exists(vieja)
+    assert os.path.exists(nueva)
+
+
+def test_gracia_protege_lo_publicado_por_otro_worker(tmp_path, monkeypatch):
+    monkeypatch.setattr(quampo_cache, 'CACHE_GRACIA', 60)
+    otro = CacheEscenas(str(tmp_path), max_bytes=1500)
+    cache = CacheEscenas(str(tmp_path), max_bytes=1500)
+    suya = otro.guardar('suya', _escribir(1000))
+    mia = cache.guardar('mia', _escribir(1000))
+    assert os.path.exists(suya) and os.path.exists(mia)
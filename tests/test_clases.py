@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from quampo_backend import CLASES_GLOSARIO, glossary, interpretar_indice
+from quampo_indices import Clases
+
+
+def _interpretar_original(valor, nombre):
+    # El if encadenado que tenía interpretar_indice antes de usar Clases
+    if nombre == 'EVI':
+        evi = max(valor, -1.0)
+        if evi > 0.8: return "Cobertura muy densa de vegetación"
+        elif evi > 0.5: return "Vegetación densa"
+        elif evi > 0.2: return "Vegetación moderada"
+        elif evi >= 0:  return "Vegetación escasa o suelo desnudo"
+        else: return "Superficie no vegetal (agua, sombra…)"
+    for r in glossary[nombre]['interpretacion']:
+        if r['rango'][0] <= valor <= r['rango'][1]:
+            return r['significado']
+    return 'Interpretación no disponible'
+
+
+def _barrido(clases, dtype):
+    # Valores densos en [-1.5, 1.5] más cada borde y sus vecinos inmediatos
+    # en `dtype`, donde se deciden los empates
+    valores = [np.linspace(-1.5, 1.5, 30001, dtype=dtype)]
+    for b in [*clases.bordes, clases.minimo, clases.maximo, 0.0]:
+        if np.isfinite(b):
+            c = dtype(b)
+            valores.append(np.array([np.nextafter(c, dtype(-np.inf)), c,
+                                     np.nextafter(c, dtype(np.inf))], dtype=dtype))
+    valores.append(np.array([-0.0, -5.0, 5.0], dtype=dtype))
+    return np.concatenate(valores)
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+@pytest.mark.parametrize('nombre', sorted(CLASES_GLOSARIO))
+def test_clasificar_igual_al_if_original(nombre, dtype):
+    clases = CLASES_GLOSARIO[nombre]
+    valores = _barrido(clases, dtype)
+    codigos = clases.clasificar(valores)
+    for v, c in zip(valores, codigos):
+        esperado = _interpretar_original(float(v), nombre)
+        assert clases.etiqueta(c) == esperado, (nombre, dtype.__name__, float(v))
+        assert interpretar_indice(float(v), nombre) == esperado, (nombre, float(v))
+
+
+def test_evi_cero_es_escasa_en_float32():
+    arr = np.array([-1e-7, 0.0, -0.0, 1e-7], dtype=np.float32)
+    etiquetas = [CLASES_GLOSARIO['EVI'].etiqueta(c) for c in CLASES_GLOSARIO['EVI'].clasificar(arr)]
+    assert etiquetas == ["Superficie no vegetal (agua, sombra…)",
+                         "Vegetación escasa o suelo desnudo",
+                         "Vegetación escasa o suelo desnudo",
+                         "Vegetación escasa o suelo desnudo"]
+
+
+def test_nan_es_sin_dato():
+    clases = Clases(['a', 'b'], [0.5], 0.0, 1.0)
+    assert list(clases.clasificar(np.array([np.nan, 0.5, 0.6, 1.5], dtype=np.float32))) == \
+        [Clases.SIN_DATO, 0, 1, Clases.FUERA_DE_RANGO]
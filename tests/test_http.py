@@ -0,0 +1,36 @@
+import asyncio
+import threading
+import time
+
+import quampo_backend as qb
+
+
+class _SesionFalsa:
+    def __init__(self):
+        self.activas = self.pico = 0
+        self.kwargs = []
+        self._lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        with self._lock:
+            self.activas += 1
+            self.pico = max(self.pico, self.activas)
+            self.kwargs.append(kwargs)
+        time.sleep(0.02)
+        with self._lock:
+            self.activas -= 1
+        return url
+
+
+def test_http_get_async_comparte_sesion_y_limites(monkeypatch):
+    sesion = _SesionFalsa()
+    monkeypatch.setattr(qb, '_sesion', sesion)
+    anteriores = qb.set_limites({'clima': 2})
+    try:
+        async def todas():
+            return await asyncio.gather(*(qb.http_get_async(f'u{i}', 'clima') for i in range(8)))
+        assert asyncio.run(todas()) == [f'u{i}' for i in range(8)]
+    finally:
+        qb.set_limites(anteriores)
+    assert sesion.pico == 2
+    assert all(k['timeout'] == (qb.HTTP_CONNECT_TIMEOUT, qb.HTTP_READ_TIMEOUT) for k in sesion.kwargs)
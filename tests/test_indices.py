@@ -0,0 +1,41 @@
+import os
+
+import numpy as np
+import pytest
+
+from quampo_backend import procesar_imagen
+from quampo_bench import generar_tif
+from quampo_cache import CacheEscenas
+
+
+@pytest.fixture
+def escena(tmp_path):
+    cache = CacheEscenas(str(tmp_path / 'cache'))
+    ruta = cache.guardar('escena', lambda tmp: generar_tif(tmp, 64))
+    return cache, ruta
+
+
+def test_hit_de_cache_no_invalida_los_arrays_perezosos(escena):
+    cache, ruta = escena
+    _, funcs, _, _ = procesar_imagen(ruta)
+    assert cache.obtener('escena') == ruta
+    ndvi = funcs['NDVI']
+    assert ndvi.shape == (64, 64) and np.isfinite(ndvi).any()
+    assert 'NDVI_clases' in funcs and funcs['NDVI_clases'].shape == (64, 64)
+
+
+def test_reescritura_en_el_lugar_falla(escena):
+    _, ruta = escena
+    _, funcs, _, _ = procesar_imagen(ruta)
+    with open(ruta, 'ab') as f:
+        f.write(b'\0')
+    with pytest.raises(RuntimeError):
+        funcs['NDVI']
+
+
+def test_escena_podada_se_sigue_leyendo(escena):
+    _, ruta = escena
+    _, funcs, _, _ = procesar_imagen(ruta)
+    os.remove(ruta)
+    assert 'NDVI' in funcs
+    assert funcs['NDVI'].shape == (64, 64)